@@ -19,6 +19,7 @@ from response import *
 from collect import *
 from perf import *
 from tools import *
+from sshbroker import *
 from mixins import *
 import traceback
 
@@ -9,6 +9,7 @@
 import re
 import socket
 import signal
+import select
 from addicted import NoAttr
 import textops
 import naghelp
@@ -18,10 +19,18 @@ import traceback
 import fcntl
 import errno
 import os
-from .tools import Timeout, TimeoutError
-
-__all__ = ['search_invalid_port', 'runsh', 'runshex', 'mrunsh', 'mrunshex', 'Expect', 'Telnet', 'Ssh', 'Snmp', 'Http',
-           'CollectError', 'ConnectionError', 'NotConnected', 'UnexpectedResultError']
+import json
+import threading
+import Queue
+import pipes
+import binascii
+import bisect
+from .tools import Timeout, TimeoutError, ResultCache, CollectFuture, COLLECTOR_POOL, limit_timeout, limit_timeout_error, monotonic
+from .sshbroker import BrokerUnavailable, broker_exec, SSH_BROKER_SOCKET, BROKER_CONNECT_KWARGS
+from .sshbroker import start_broker as start_ssh_broker
+
+__all__ = ['search_invalid_port', 'search_invalid_ports', 'probe_ports', 'runsh', 'runshex', 'runsh_iter', 'mrunsh', 'mrunshex', 'Expect', 'ExpectSteps', 'Telnet', 'Ssh', 'AsyncCollector', 'AsyncExpect', 'AsyncTelnet', 'AsyncSsh', 'Snmp', 'SnmpPoller', 'SnmpTable', 'OidIndex', 'MibCache', 'MIB_CACHE', 'SnmpDiscoveryCache', 'get_snmp_engine', 'Http',
+           'ResultMatcher', 'PromptScanner', 'CollectError', 'ConnectionError', 'NotConnected', 'UnexpectedResultError', 'ParallelCollectError']
 
 class CollectError(Exception):
     """Exception raised when a collect is unsuccessful
@@ -55,9 +64,164 @@ class UnexpectedResultError(CollectError):
     """
     pass
 
+class ParallelCollectError(CollectError):
+    """Exception raised when some commands run at the same time have failed
+
+    All commands are run, then this exception is raised if at least one has failed.
+    ``errors`` is the dictionary key -> exception of the failed commands and ``results`` the
+    dictionary of the results of the commands that succeeded, as it would have been returned.
+
+    Args:
+
+        errors (list): List of tuples (key, exception) in commands order
+        results (dict): The results of the commands that succeeded
+    """
+    def __init__(self, errors, results):
+        self.errors = textops.DictExt(errors)
+        self.results = results
+        msg = '\n'.join([ '%s : %s' % (k,e) for k,e in errors ])
+        CollectError.__init__(self, '%s command(s) failed :\n%s' % (len(errors),msg))
+
+PORTS_CACHE_PATTERN = '/tmp/naghelp/%s_ports_cache.json'
+"""Pattern for the file where :func:`probe_ports` caches the ports status (``%s`` is replaced by the ip)"""
+
+def _normalize_ports(ports):
+    if isinstance(ports, basestring):
+        ports = ports.split(',')
+    return [ int(n) for n in ports if str(n).strip() ]
+
+def _load_ports_cache(ip, ttl):
+    try:
+        with open(PORTS_CACHE_PATTERN % ip) as fh:
+            cache = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return {}
+    now = time.time()
+    return dict([ (int(port),ok) for port,(date,ok) in cache.items() if 0 <= now - date < ttl ])
+
+def _save_ports_cache(ip, status):
+    filename = PORTS_CACHE_PATTERN % ip
+    try:
+        with open(filename) as fh:
+            cache = json.load(fh)
+    except (IOError, OSError, ValueError):
+        cache = {}
+    now = time.time()
+    cache.update([ (str(port),(now,ok)) for port,ok in status.items() ])
+    try:
+        filedir = os.path.dirname(filename)
+        if not os.path.exists(filedir):
+            os.makedirs(filedir)
+        tmp_filename = '%s.%s' % (filename,os.getpid())
+        with open(tmp_filename,'w') as fh:
+            json.dump(cache,fh)
+        os.rename(tmp_filename,filename)
+    except (IOError, OSError),e:
+        naghelp.logger.debug('collect -> cannot save ports cache %s : %s',filename,e)
+
+def probe_ports(ip, ports, timeout=1, cache_ttl=30):
+    """Test whether TCP ports are reachable
+
+    All ports are tested at the same time with non-blocking connections and one overall timeout.
+    The status is cached on disk for ``cache_ttl`` seconds per ip/port (see
+    :data:`PORTS_CACHE_PATTERN`) : this avoids probing again the same host when many nagios
+    services are checking it at the same time.
+
+    Args:
+
+        ip (str): ip address to test
+        ports (str or list of int): list of ports to test
+        timeout (int or float): the overall time in seconds to wait for connections (Default : 1)
+        cache_ttl (int): how long in seconds a port status is kept in cache (Default : 30),
+            0 disables the cache.
+
+    Returns:
+
+        dict: port (int) -> True if reachable, False otherwise
+
+    Examples:
+
+        >>> probe_ports('8.8.8.8','53,22,80')  #doctest: +SKIP
+        {80: False, 53: True, 22: False}
+    """
+    ports = _normalize_ports(ports)
+    status = _load_ports_cache(ip, cache_ttl) if cache_ttl else {}
+    status = dict([ (port,status[port]) for port in ports if port in status ])
+    to_probe = [ port for port in ports if port not in status ]
+    if not to_probe:
+        return status
+    probed = dict([ (port,False) for port in to_probe ])
+    try:
+        family,socktype,proto,canonname,sockaddr = socket.getaddrinfo(ip, None, 0, socket.SOCK_STREAM)[0]
+    except socket.error,e:
+        naghelp.logger.debug('collect -> cannot resolve %s : %s',ip,e)
+        family = None
+    if family is not None:
+        poller = select.poll()
+        pending = {}
+        for port in to_probe:
+            s = socket.socket(family, socket.SOCK_STREAM)
+            s.setblocking(0)
+            err = s.connect_ex((sockaddr[0],port) + tuple(sockaddr[2:]))
+            if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                pending[s.fileno()] = (s,port)
+                poller.register(s.fileno(), select.POLLOUT)
+            else:
+                probed[port] = err == 0
+                s.close()
+        deadline = monotonic() + limit_timeout(timeout)
+        while pending:
+            wait_ms = (deadline - monotonic()) * 1000
+            if wait_ms <= 0:
+                break
+            try:
+                events = poller.poll(int(wait_ms) + 1)
+            except select.error,e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd,event in events:
+                s,port = pending.pop(fd)
+                poller.unregister(fd)
+                probed[port] = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+                s.close()
+        for s,port in pending.values():
+            s.close()
+    if cache_ttl:
+        _save_ports_cache(ip, probed)
+    status.update(probed)
+    return status
+
+def search_invalid_ports(ip,ports,timeout=1,cache_ttl=30):
+    """Returns the list of invalid ports
+
+    It uses :func:`probe_ports` to test all the ports at the same time.
+
+    Args:
+
+        ip (str): ip address to test
+        ports (str or list of int): list of ports to test
+        timeout (int or float): the overall time in seconds to wait for connections (Default : 1)
+        cache_ttl (int): how long in seconds a port status is kept in cache (Default : 30)
+
+    Returns:
+
+        list: The unreachable ports in the same order as ``ports`` (empty list if all are reachable)
+
+    Examples:
+
+        >>> search_invalid_ports('8.8.8.8','53,22,80')  #doctest: +SKIP
+        [22, 80]
+    """
+    ports = _normalize_ports(ports)
+    status = probe_ports(ip, ports, timeout, cache_ttl)
+    return [ port for port in ports if not status.get(port) ]
+
 def search_invalid_port(ip,ports):
     """Returns the first invalid port encountered or None if all are reachable
 
+    It uses :func:`probe_ports` to test all the ports at the same time.
+
     Args:
 
         ip (str): ip address to test
@@ -69,22 +233,13 @@ def search_invalid_port(ip,ports):
 
     Examples:
 
-        >>> search_invalid_port('8.8.8.8','53')
+        >>> search_invalid_port('8.8.8.8','53')  #doctest: +SKIP
         (None)
-        >>> search_invalid_port('8.8.8.8','53,22,80')
+        >>> search_invalid_port('8.8.8.8','53,22,80')  #doctest: +SKIP
         22
     """
-    if isinstance(ports, basestring):
-        ports = [ int(n) for n in ports.split(',') ]
-    for port in ports:
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(1)
-            s.connect((ip, port))
-            s.close()
-        except:
-            return port
-    return None
+    invalid_ports = search_invalid_ports(ip,ports)
+    return invalid_ports[0] if invalid_ports else None
 
 def _raise_unexpected_result(result, key, cmd, help_str=''):
     if isinstance(result,textops.ListExt):
@@ -100,30 +255,142 @@ def _raise_unexpected_result(result, key, cmd, help_str=''):
     s='Unexpected result %s\nCommand = %s\n%s\n\n%s\n\nNOTE : Due to nagios restrictions, pipe symbol has been replaced by "!"' % (key_str,cmd,help_str,result)
     raise UnexpectedResultError(s)
 
-def _filter_result(result, key, cmd, expected_pattern=r'\S', unexpected_pattern=None, filter=None):
-    if callable(filter):
-        filtered = filter(result, key, cmd)
-        if filtered is not None:
-            result = filtered
+class ResultMatcher(object):
+    r"""Precompiled expected/unexpected patterns tester
 
-    if unexpected_pattern:
-        if isinstance(unexpected_pattern,basestring):
-            unexpected_pattern = re.compile(unexpected_pattern)
-        if result and result | textops.haspattern(unexpected_pattern):
-            help_str = '-> found the pattern "%s" :\n\n' % unexpected_pattern.pattern
-            help_str += result | textops.findhighlight(unexpected_pattern,line_nbr=True,nlines=5).tostr()
-            _raise_unexpected_result(result, key, cmd, help_str)
+    All collecting methods check their result against an ``expected_pattern`` and an
+    ``unexpected_pattern``. A :class:`ResultMatcher` compiles these patterns once and then tests both
+    of them in a single pass over the result lines. Matchers are cached at class level : use
+    :meth:`get` to have a matcher built only once per process for a given couple of patterns.
+    A matcher can be used on its own, for example at plugin level to check some collected data.
+
+    Args:
+
+        expected_pattern (str or regex): the result must have at least one line matching this pattern.
+            if None, there is no test. By default, tests the result is not empty.
+        unexpected_pattern (str or regex): the result must have no line matching this pattern.
+            if None, there is no test. By default, there is no test.
 
-    if expected_pattern:
+    Examples:
+
+        >>> m = ResultMatcher(r'\d+', r'(?i)error')
+        >>> m.check('value = 123')
+        'value = 123'
+        >>> m.check('value = 123\nERROR : bad value')  #doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        UnexpectedResultError: Unexpected result...
+        >>> ResultMatcher.get(r'\S',None) is ResultMatcher.get(r'\S',None)
+        True
+        >>> ResultMatcher().check(0)
+        0
+        >>> ResultMatcher().check([])  #doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        UnexpectedResultError: Unexpected result...-> empty result...
+    """
+    cache_size = 256
+    """Maximum number of matchers kept in cache by :meth:`get`"""
+
+    _cache = {}
+
+    def __init__(self, expected_pattern=r'\S', unexpected_pattern=None):
         if isinstance(expected_pattern,basestring):
             expected_pattern = re.compile(expected_pattern)
-        if not result | textops.haspattern(expected_pattern):
-            if expected_pattern.pattern==r'\S':
+        if isinstance(unexpected_pattern,basestring):
+            unexpected_pattern = re.compile(unexpected_pattern)
+        self.expected_pattern = expected_pattern or None
+        self.unexpected_pattern = unexpected_pattern or None
+
+    @classmethod
+    def get(cls, expected_pattern=r'\S', unexpected_pattern=None):
+        """Get a matcher from the cache, create it if not already done
+
+        Args:
+
+            expected_pattern (str or regex): see :class:`ResultMatcher`
+            unexpected_pattern (str or regex): see :class:`ResultMatcher`
+
+        Returns:
+
+            :class:`ResultMatcher`: The cached matcher
+        """
+        key = (expected_pattern, unexpected_pattern)
+        matcher = cls._cache.get(key)
+        if matcher is None:
+            if len(cls._cache) >= cls.cache_size:
+                cls._cache.clear()
+            matcher = cls._cache[key] = cls(expected_pattern, unexpected_pattern)
+        return matcher
+
+    def _lines(self, result):
+        if result is None:
+            return ()
+        if isinstance(result,basestring):
+            return result.splitlines()
+        if isinstance(result,(list,tuple)):
+            return result
+        # numbers and other objects are checked on their string form
+        return str(result).splitlines()
+
+    def check(self, result, key='', cmd=''):
+        """Check the result against the patterns
+
+        Args:
+
+            result (str or list): The result to check
+            key (str): The key of the result (for ``mrun``, ``mget`` and ``mwalk``) to appear
+                in UnexpectedResultError if any.
+            cmd (str): The command that generated the result to appear in UnexpectedResultError
+                if any.
+
+        Returns:
+
+            The result unchanged
+
+        Raises:
+
+            UnexpectedResultError: if ``unexpected_pattern`` is found or if ``expected_pattern``
+                is not found.
+        """
+        unexpected_search = self.unexpected_pattern.search if self.unexpected_pattern else None
+        expected_search = self.expected_pattern.search if self.expected_pattern else None
+        if unexpected_search is None and expected_search is None:
+            return result
+        found = expected_search is None
+        lines = self._lines(result)
+        for line in lines:
+            if not isinstance(line,basestring):
+                line = str(line)
+            if unexpected_search is not None and unexpected_search(line):
+                help_str = '-> found the pattern "%s" :\n\n' % self.unexpected_pattern.pattern
+                help_str += lines | textops.findhighlight(self.unexpected_pattern,line_nbr=True,nlines=5).tostr()
+                _raise_unexpected_result(result, key, cmd, help_str)
+            if not found and expected_search(line):
+                found = True
+                if unexpected_search is None:
+                    break
+        if not found:
+            if self.expected_pattern.pattern==r'\S':
                 _raise_unexpected_result(result, key, cmd, '-> empty result')
             else:
-                _raise_unexpected_result(result, key, cmd, '-> cannot find the pattern "%s"' % expected_pattern.pattern)
+                _raise_unexpected_result(result, key, cmd, '-> cannot find the pattern "%s"' % self.expected_pattern.pattern)
+        return result
+
+#: The cache used by collectors having a ``cache_ttl`` parameter
+RESULT_CACHE = ResultCache()
 
-    return result
+def _cached_collect(cache_ttl, key, collect):
+    if not cache_ttl:
+        return collect()
+    return RESULT_CACHE.get_or_collect(key, cache_ttl, collect)
+
+def _filter_result(result, key, cmd, expected_pattern=r'\S', unexpected_pattern=None, filter=None):
+    if callable(filter):
+        filtered = filter(result, key, cmd)
+        if filtered is not None:
+            result = filtered
+    return ResultMatcher.get(expected_pattern, unexpected_pattern).check(result, key, cmd)
 
 def _debug_caller_info():
     if naghelp.logger.getEffectiveLevel() == naghelp.logging.DEBUG:
@@ -140,11 +407,280 @@ def _debug_caller(self):
     file_line,prev_call = self._debug_caller_info()
     return file_line
 
+TRUNCATED_MARKER = '<output truncated>'
+"""String added at the end of a local command output when it has been truncated (see ``max_output``)"""
+
+SHELL_FAST_PATH = True
+"""When True, simple string commands (no shell special characters) are executed without a shell"""
+
+_SHELL_SPECIAL_CHARS = re.compile(r'[|&;<>()$`\\"\'*?\[\]#~{}!\n]')
+_SHELL_BUILTINS = set(['.', ':', 'alias', 'bg', 'break', 'cd', 'command', 'continue', 'eval',
+                       'exec', 'exit', 'export', 'fg', 'getopts', 'hash', 'jobs', 'local',
+                       'read', 'readonly', 'return', 'set', 'shift', 'source', 'times', 'trap',
+                       'type', 'ulimit', 'umask', 'unalias', 'unset', 'wait'])
+
+def _split_simple_cmd(cmd):
+    # returns the argument list if the command does not need a shell to be executed, None otherwise
+    if not SHELL_FAST_PATH or _SHELL_SPECIAL_CHARS.search(cmd):
+        return None
+    args = cmd.split()
+    if not args or args[0] in _SHELL_BUILTINS or '=' in args[0]:
+        return None
+    return args
+
+def _popen(cmd, context, stderr=subprocess.PIPE):
+    # The command gets its own process group in order to kill its sub-processes too
+    if isinstance(cmd, basestring):
+        if context:
+            cmd = cmd.format(**context)
+        args = _split_simple_cmd(cmd)
+        if args:
+            try:
+                return subprocess.Popen(args,stdout=subprocess.PIPE,stderr=stderr,preexec_fn=os.setsid)
+            except OSError:
+                # let the shell report the error (command not found...) as usual
+                pass
+        return subprocess.Popen(['sh','-c',cmd],stdout=subprocess.PIPE,stderr=stderr,preexec_fn=os.setsid)
+    if context:
+        cmd = [ i.format(**context) for i in cmd ]
+    return subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=stderr,preexec_fn=os.setsid)
+
+def _kill_process(p, grace=0.2):
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(p.pid, sig)
+        except OSError:
+            pass
+        end = monotonic() + grace
+        while p.poll() is None and monotonic() < end:
+            time.sleep(0.01)
+        if p.returncode is not None:
+            break
+    for f in (p.stdout, p.stderr):
+        if f is not None:
+            f.close()
+    p.wait()
+
+def _read_process(p, timeout, max_output=None, error_message='Timeout'):
+    """Read process stdout and stderr pipes without blocking
+
+    Outputs are streamed into bytearrays. When ``max_output`` bytes are reached on a pipe, the
+    output is truncated, :data:`TRUNCATED_MARKER` is appended and the process is killed.
+    When ``timeout`` is reached, the process is killed and a :class:`TimeoutError` is raised.
+
+    Returns:
 
-def runsh(cmd, context = {}, timeout = 30, expected_pattern=r'\S', unexpected_pattern=None, filter=None, key='' ):
+        tuple: stdout, stderr (None if not piped)
+    """
+    deadline = monotonic() + timeout if timeout else None
+    fds = [ f.fileno() if f is not None else None for f in (p.stdout, p.stderr) ]
+    buffers = {}
+    poller = select.poll()
+    for fd in fds:
+        if fd is not None:
+            buffers[fd] = bytearray()
+            poller.register(fd, select.POLLIN | select.POLLPRI | select.POLLHUP)
+    opened = len(buffers)
+    truncated = False
+    while opened and not truncated:
+        wait_ms = None
+        if deadline is not None:
+            wait_ms = (deadline - monotonic()) * 1000
+            if wait_ms <= 0:
+                _kill_process(p)
+                raise TimeoutError(error_message)
+            wait_ms = int(wait_ms) + 1
+        try:
+            events = poller.poll(wait_ms)
+        except select.error,e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd,event in events:
+            data = os.read(fd, 65536)
+            if not data:
+                poller.unregister(fd)
+                opened -= 1
+                continue
+            buff = buffers[fd]
+            buff += data
+            if max_output and len(buff) > max_output:
+                del buff[max_output:]
+                buff += '\n' + TRUNCATED_MARKER
+                truncated = True
+    if truncated:
+        naghelp.logger.debug('collect -> output truncated to %s bytes : killing the process',max_output)
+        _kill_process(p)
+    else:
+        while p.poll() is None:
+            if deadline is not None and monotonic() >= deadline:
+                _kill_process(p)
+                raise TimeoutError(error_message)
+            time.sleep(0.01)
+    for f in (p.stdout, p.stderr):
+        if f is not None:
+            f.close()
+    return tuple( str(buffers[fd]) if fd is not None else None for fd in fds )
+
+def _run_process(cmd, context, timeout, stderr=subprocess.PIPE, error_message='Timeout', max_output=None):
+    # Thread-safe : the timeout kills the process instead of relying on SIGALRM
+    p = _popen(cmd, context, stderr)
+    try:
+        stdout, stderr = _read_process(p, timeout, max_output, error_message)
+    except:
+        # an outer Timeout occured : do not leave the process behind
+        _kill_process(p)
+        raise
+    return stdout, stderr or '', p.returncode
+
+def _new_batch_marker():
+    return 'NAGHELP_BATCH_%s' % binascii.hexlify(os.urandom(8))
+
+def _build_batch_script(cmds, context, marker, interactive=False, pty=False):
+    # Each command is run in a subshell (the shell execs simple commands without an extra fork),
+    # then a marker with the command index and its return code is written on stdout and stderr.
+    # For an interactive shell, the script is a single line beginning with a start marker
+    # and the markers are only written on stdout. With a pty, stderr is merged into stdout :
+    # the markers are only written on stdout too.
+    lines = []
+    if interactive:
+        lines.append("printf '\\n%s:start\\n'" % marker)
+    for i,cmd in enumerate(cmds):
+        if isinstance(cmd, basestring):
+            if context:
+                cmd = cmd.format(**context)
+        else:
+            if context:
+                cmd = [ arg.format(**context) for arg in cmd ]
+            cmd = ' '.join([ pipes.quote(arg) for arg in cmd ])
+        if interactive:
+            lines.append("( %s ); printf '\\n%s:%s:%%s\\n' $?" % (cmd,marker,i))
+        else:
+            lines.append('(\n%s\n)' % cmd)
+            if pty:
+                lines.append("rc=$?; printf '\\n%s:%s:%%s\\n' $rc" % (marker,i))
+            else:
+                lines.append("rc=$?; printf '\\n%s:%s:%%s\\n' $rc; printf '\\n%s:%s:%%s\\n' $rc >&2" % (marker,i,marker,i))
+    return ('; ' if interactive else '\n').join(lines)
+
+def _get_batch_end_pattern(marker, nb_cmds):
+    # the line end is not consumed : the prompt pattern may need it
+    return re.compile(r'\n%s:%s:\d+(?=\r?\n)' % (marker,nb_cmds-1))
+
+def _split_batch_output(output, marker, nb_cmds):
+    # returns a list of (output, return code) tuples, one per command
+    # (a pty ends the lines with \r\n)
+    results = [ ('',None) ] * nb_cmds
+    chunks = re.split(r'\r?\n%s:(\d+):(\d+)\r?\n' % marker, output)
+    for n in range(0,len(chunks)-1,3):
+        results[int(chunks[n+1])] = (chunks[n], int(chunks[n+2]))
+    i = len(chunks) // 3
+    if chunks[-1] and i < nb_cmds:
+        # partial output of the command that was running when the batch has been stopped
+        results[i] = (chunks[-1], None)
+    return results
+
+def _split_interactive_batch_output(output, marker, nb_cmds):
+    # returns a list of outputs, one per command, without the script echo and the prompt
+    output = output.replace('\r','')
+    start = '\n%s:start\n' % marker
+    pos = output.find(start)
+    if pos >= 0:
+        output = output[pos+len(start):]
+    return [ re.sub(r'\n$','',out) for out,rcode in _split_batch_output(output + '\n', marker, nb_cmds) ]
+
+def _run_batch(cmds, context, timeout, error_message='Timeout', max_output=None):
+    # Runs all commands with a single shell, returns a list of (stdout, stderr, returncode)
+    marker = _new_batch_marker()
+    script = _build_batch_script(cmds, context, marker)
+    stdout, stderr, rcode = _run_process(['sh','-c',script], None, timeout, error_message=error_message, max_output=max_output)
+    stdout_results = _split_batch_output(stdout, marker, len(cmds))
+    stderr_results = _split_batch_output(stderr, marker, len(cmds))
+    return [ (out,err,rc) for (out,rc),(err,_) in zip(stdout_results,stderr_results) ]
+
+def _iter_process_lines(p, timeout, error_message='Timeout'):
+    """Yield process stdout lines as soon as they are available"""
+    deadline = monotonic() + timeout if timeout else None
+    fd = p.stdout.fileno()
+    poller = select.poll()
+    poller.register(fd, select.POLLIN | select.POLLPRI | select.POLLHUP)
+    pending = bytearray()
+    while True:
+        wait_ms = None
+        if deadline is not None:
+            wait_ms = (deadline - monotonic()) * 1000
+            if wait_ms <= 0:
+                raise TimeoutError(error_message)
+            wait_ms = int(wait_ms) + 1
+        try:
+            if not poller.poll(wait_ms):
+                continue
+        except select.error,e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        pending += data
+        start = 0
+        end = pending.find('\n')
+        while end >= 0:
+            yield str(pending[start:end])
+            start = end + 1
+            end = pending.find('\n', start)
+        del pending[:start]
+    if pending:
+        yield str(pending)
+
+def _run_parallel(tasks, workers, timeout, error_message):
+    """Run ``(key, callable)`` tasks with a pool of threads
+
+    Returns a list of ``(key, result, exception)`` tuples in the same order as ``tasks``.
+    Tasks that have not finished within ``timeout`` seconds (or within the time left of an
+    enclosing :class:`Timeout`) get a :class:`TimeoutError`. Each task runs within a
+    :class:`Timeout` block so that collectors get the remaining time budget.
+    """
+    queue = Queue.Queue()
+    for i,task in enumerate(tasks):
+        queue.put((i,task))
+    results = [ None ] * len(tasks)
+    timeout, error_message = limit_timeout_error(timeout, error_message)
+    deadline = monotonic() + timeout
+
+    def worker():
+        while True:
+            try:
+                i,(key,func) = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                with Timeout(seconds=max(deadline - monotonic(),0.001), error_message=error_message):
+                    results[i] = (key, func(), None)
+            except Exception,e:
+                results[i] = (key, None, e)
+
+    threads = [ threading.Thread(target=worker) for n in range(min(workers,len(tasks))) ]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join(max(deadline - monotonic(),0))
+    for i,(key,func) in enumerate(tasks):
+        if results[i] is None:
+            results[i] = (key, None, TimeoutError(error_message))
+    return results
+
+def _check_parallel_errors(errors, results):
+    # errors : list of (key, exception) in tasks order
+    if errors:
+        raise ParallelCollectError(errors, results)
+
+def runsh(cmd, context = {}, timeout = 30, expected_pattern=r'\S', unexpected_pattern=None, filter=None, key='', max_output=None, cache_ttl=None ):
     r"""Run a local command with a timeout
 
-    | If the command is a string, it will be executed within a shell.
+    | If the command is a string, it will be executed within a shell
+      (or directly if it is a simple command, see :data:`SHELL_FAST_PATH`).
     | If the command is a list (the command and its arguments), the command is executed without a shell.
     | If a context dict is specified, the command is formatted with that context (:meth:`str.format`)
 
@@ -152,8 +688,9 @@ def runsh(cmd, context = {}, timeout = 30, expected_pattern=r'\S', unexpected_pa
 
         cmd (str or a list): The command to run
         context (dict): The context to format the command to run (Optional)
-        timeout (int): The timeout in seconds after with the forked process is killed
-            and TimeoutException is raised (Default : 30s).
+        timeout (int or float): The timeout in seconds after with the forked process is killed
+            and TimeoutException is raised (Default : 30s). It is limited to the time left
+            of an enclosing :class:`Timeout` block if any.
         expected_pattern (str or regex): raise UnexpectedResultError if the pattern is not found.
             if None, there is no test. By default, tests the result is not empty.
         unexpected_pattern (str or regex): raise UnexpectedResultError if the pattern is found
@@ -166,6 +703,11 @@ def runsh(cmd, context = {}, timeout = 30, expected_pattern=r'\S', unexpected_pa
             ``mget`` and ``mwalk``.
             By Default, there is no filter.
         key (str): a key string to appear in UnexpectedResultError if any.
+        max_output (int): Maximum number of bytes to read from the command output (Default : None
+            = no limit). Above that, the output is truncated, :data:`TRUNCATED_MARKER` is added
+            at the end and the command is killed.
+        cache_ttl (int): If set, the command output is stored in :data:`RESULT_CACHE` for
+            ``cache_ttl`` seconds and shared with other plugin processes (Default : None = no cache).
 
     Returns:
 
@@ -177,7 +719,7 @@ def runsh(cmd, context = {}, timeout = 30, expected_pattern=r'\S', unexpected_pa
 
     Examples:
 
-        >>> for line in runsh('ls -lad /etc/e*'):
+        >>> for line in runsh('ls -lad /etc/e*'):  #doctest: +SKIP
         ...     print line
         ...
         -rw-r--r-- 1 root root  392 oct.   8  2013 /etc/eclipse.ini
@@ -187,25 +729,29 @@ def runsh(cmd, context = {}, timeout = 30, expected_pattern=r'\S', unexpected_pa
         -rw-r--r-- 1 root root   79 avril 25  2012 /etc/environment
         drwxr-xr-x 2 root root 4096 mai    1  2012 /etc/esound
 
-        >>> print runsh('ls -lad /etc/e*').grep('eclipse').tostr()
+        >>> print runsh('ls -lad /etc/e*').grep('eclipse').tostr()  #doctest: +SKIP
         -rw-r--r-- 1 root root  392 oct.   8  2013 /etc/eclipse.ini
         -rw-r--r-- 1 root root  350 mai   21  2012 /etc/eclipse.ini_old
 
-        >>> l=runsh('LANG=C ls -lad /etc/does_not_exist')
+        >>> l=runsh('LANG=C ls -lad /etc/does_not_exist',expected_pattern=None)
         >>> print l
         []
-        >>> l=runsh('LANG=C ls -lad /etc/does_not_exist 2>&1')
-        >>> print l
+        >>> l=runsh('LANG=C ls -lad /etc/does_not_exist 2>&1',expected_pattern=None)  #doctest: +SKIP
+        >>> print l  #doctest: +SKIP
         ['ls: cannot access /etc/does_not_exist: No such file or directory']
     """
-    with Timeout(seconds=timeout, error_message='Timeout (%ss) for command : %s' % (timeout,cmd)):
-        result = textops.run(cmd, context).l
+    timeout, error_message = limit_timeout_error(timeout, 'Timeout (%ss) for command : %s' % (timeout,cmd))
+    with Timeout(seconds=timeout, error_message=error_message):
+        collect = lambda: _run_process(cmd, context, timeout, stderr=None, error_message=error_message, max_output=max_output)[0]
+        stdout = _cached_collect(cache_ttl, ('local',socket.gethostname(),cmd,context), collect)
+        result = textops.ListExt(stdout.splitlines())
         return _filter_result(result, key, cmd, expected_pattern, unexpected_pattern, filter)
 
-def runshex(cmd, context = {}, timeout = 30, expected_pattern=r'\S', unexpected_pattern=None,filter=None, key='',unexpected_stderr=True ):
+def runshex(cmd, context = {}, timeout = 30, expected_pattern=r'\S', unexpected_pattern=None,filter=None, key='',unexpected_stderr=True, max_output=None, cache_ttl=None ):
     r"""Run a local command with a timeout
 
-    | If the command is a string, it will be executed within a shell.
+    | If the command is a string, it will be executed within a shell
+      (or directly if it is a simple command, see :data:`SHELL_FAST_PATH`).
     | If the command is a list (the command and its arguments), the command is executed without a shell.
     | If a context dict is specified, the command is formatted with that context (:meth:`str.format`)
 
@@ -213,8 +759,9 @@ def runshex(cmd, context = {}, timeout = 30, expected_pattern=r'\S', unexpected_
 
         cmd (str or a list): The command to run
         context (dict): The context to format the command to run (Optional)
-        timeout (int): The timeout in seconds after with the forked process is killed
-            and TimeoutException is raised (Default : 30s).
+        timeout (int or float): The timeout in seconds after with the forked process is killed
+            and TimeoutException is raised (Default : 30s). It is limited to the time left
+            of an enclosing :class:`Timeout` block if any.
         expected_pattern (str or regex): raise UnexpectedResultError if the pattern is not found.
             if None, there is no test. By default, tests the result is not empty.
         unexpected_pattern (str or regex): raise UnexpectedResultError if the pattern is found
@@ -228,6 +775,12 @@ def runshex(cmd, context = {}, timeout = 30, expected_pattern=r'\S', unexpected_
             By Default, there is no filter.
         key (str): a key string to appear in UnexpectedResultError if any.
         unexpected_stderr (bool): When True (Default), it raises an error if stderr is not empty
+        max_output (int): Maximum number of bytes to read from the command stdout and from stderr
+            (Default : None = no limit). Above that, the output is truncated,
+            :data:`TRUNCATED_MARKER` is added at the end and the command is killed.
+        cache_ttl (int): If set, stdout, stderr and the return code are stored in
+            :data:`RESULT_CACHE` for ``cache_ttl`` seconds and shared with other plugin processes
+            (Default : None = no cache).
 
     Returns:
 
@@ -237,30 +790,92 @@ def runshex(cmd, context = {}, timeout = 30, expected_pattern=r'\S', unexpected_
 
         It returns **ONLY** stdout. If you want to get stderr, you need to redirect it to stdout.
     """
-    with Timeout(seconds=timeout, error_message='Timeout (%ss) for command : %s' % (timeout,cmd)):
+    timeout, error_message = limit_timeout_error(timeout, 'Timeout (%ss) for command : %s' % (timeout,cmd))
+    with Timeout(seconds=timeout, error_message=error_message):
         if isinstance(cmd, basestring):
             if context:
                 cmd = cmd.format(**context)
-            p=subprocess.Popen(['sh','-c',cmd],stdout=subprocess.PIPE,stderr=subprocess.PIPE)
         elif isinstance(cmd, list):
             if context:
                 cmd = [ i.format(**context) for i in cmd ]
-            p=subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        stdout_msg = ''
-        stderr_msg = ''
-        while p.returncode is None:
-            (stdout, stderr) = p.communicate()
-            stdout_msg += stdout
-            stderr_msg += stderr
+        collect = lambda: _run_process(cmd, None, timeout, error_message=error_message, max_output=max_output)
+        stdout_msg,stderr_msg,rcode = _cached_collect(cache_ttl, ('localex',socket.gethostname(),cmd), collect)
         if isinstance(cmd, unicode):
             cmd=cmd.encode('utf-8','replace')
         else:
             cmd=str(cmd)
         if unexpected_stderr and stderr_msg:
             _raise_unexpected_result(stderr_msg, key, cmd, help_str='<stderr> returned :')
-        return _filter_result(stdout_msg, key, cmd, expected_pattern, unexpected_pattern, filter),stderr_msg,p.returncode
+        return _filter_result(stdout_msg, key, cmd, expected_pattern, unexpected_pattern, filter),stderr_msg,rcode
+
+def runsh_iter(cmd, context = {}, timeout = 30, expected_pattern=r'\S', unexpected_pattern=None, key=''):
+    r"""Run a local command and yield its output lines as soon as they are available
+
+    It works like :func:`runsh` except that the output is not stored in memory : lines are
+    generated while the command is running. This is useful to grep only a few lines from a huge
+    output (``dmesg``, logs...) with a flat memory usage. ``unexpected_pattern`` is tested on
+    each line as it arrives. ``expected_pattern`` is tested on each line too, the error is raised
+    at the end if it has not been found. If the caller stops iterating (``break``, exception or
+    generator garbage collected), the command is killed.
+
+    Args:
+
+        cmd (str or a list): The command to run
+        context (dict): The context to format the command to run (Optional)
+        timeout (int or float): The timeout in seconds for the whole iteration after which the
+            forked process is killed and TimeoutException is raised (Default : 30s).
+            It is limited to the time left of an enclosing :class:`Timeout` block if any.
+        expected_pattern (str or regex): raise UnexpectedResultError if the pattern is not found.
+            if None, there is no test. By default, tests the result is not empty.
+        unexpected_pattern (str or regex): raise UnexpectedResultError if the pattern is found
+            if None, there is no test. By default, there is no test.
+        key (str): a key string to appear in UnexpectedResultError if any.
+
+    Yields:
 
-def mrunsh(cmds, context = {},cmd_timeout = 30, total_timeout = 60, expected_pattern=r'\S', unexpected_pattern=None, filter=None):
+        str: Command execution stdout lines
+
+    Examples:
+
+        >>> for line in runsh_iter('dmesg'):  #doctest: +SKIP
+        ...     if 'eth0' in line:
+        ...         print line
+        ...         break
+        ...
+        [    2.110356] e1000e 0000:00:19.0 eth0: (PCI Express:2.5GT/s:Width x1) 00:1c:c0:9a:5f:ee
+
+        >>> textops.ListExt(runsh_iter('dmesg')).grep('ata1')  #doctest: +SKIP
+        ['[    1.436710] ata1: SATA max UDMA/133 abar m2048@0xf7e1a000 port 0xf7e1a100 irq 27', ...]
+    """
+    timeout, error_message = limit_timeout_error(timeout, 'Timeout (%ss) for command : %s' % (timeout,cmd))
+    matcher = ResultMatcher.get(expected_pattern, unexpected_pattern)
+    expected_pattern = matcher.expected_pattern
+    unexpected_pattern = matcher.unexpected_pattern
+    p = _popen(cmd, context, stderr=None)
+    try:
+        found = not expected_pattern
+        nb_lines = 0
+        for line in _iter_process_lines(p, timeout, error_message):
+            nb_lines += 1
+            if unexpected_pattern and unexpected_pattern.search(line):
+                help_str = '-> found the pattern "%s" at line %s :\n\n' % (unexpected_pattern.pattern,nb_lines)
+                _raise_unexpected_result(line, key, cmd, help_str)
+            if not found and expected_pattern.search(line):
+                found = True
+            yield line
+        if not found:
+            result = '<%s lines read>' % nb_lines
+            if expected_pattern.pattern==r'\S':
+                _raise_unexpected_result(result, key, cmd, '-> empty result')
+            else:
+                _raise_unexpected_result(result, key, cmd, '-> cannot find the pattern "%s"' % expected_pattern.pattern)
+    finally:
+        if p.poll() is None:
+            naghelp.logger.debug('collect -> runsh_iter() : killing "%s"',cmd)
+        # reap the process and its sub-processes, even when the caller stopped iterating
+        _kill_process(p)
+
+def mrunsh(cmds, context = {},cmd_timeout = 30, total_timeout = 60, expected_pattern=r'\S', unexpected_pattern=None, filter=None, workers=1, max_output=None, cache_ttl=None, batch=False):
     r"""Run multiple local commands with timeouts
 
     It works like :func:`runsh` except that one must provide a dictionary of commands.
@@ -271,7 +886,8 @@ def mrunsh(cmds, context = {},cmd_timeout = 30, total_timeout = 60, expected_pat
 
         cmds (dict): dictionary where values are the commands to execute.
 
-            | If the command is a string, it will be executed within a shell.
+            | If the command is a string, it will be executed within a shell
+              (or directly if it is a simple command, see :data:`SHELL_FAST_PATH`).
             | If the command is a list (the command and its arguments), the command is executed without a shell.
             | If a context dict is specified, the command is formatted with that context (:meth:`str.format`)
 
@@ -289,6 +905,18 @@ def mrunsh(cmds, context = {},cmd_timeout = 30, total_timeout = 60, expected_pat
             that generated the ``result`` and ``key`` the key in the dictionary for ``mrun``,
             ``mget`` and ``mwalk``.
             By Default, there is no filter.
+        workers (int): The number of commands to run at the same time (Default : 1, that is
+            commands are run one after another). Each command still has its own ``cmd_timeout``
+            and the whole dictionary must be done within ``total_timeout``.
+        max_output (int): Maximum number of bytes to read from each command output
+            (Default : None = no limit, see :func:`runshex`).
+        cache_ttl (int): If set, each command output is stored in :data:`RESULT_CACHE` for
+            ``cache_ttl`` seconds (Default : None = no cache, see :func:`runsh`).
+        batch (bool): When True, all commands are sent as one script to a single shell process
+            instead of forking a shell per command (Default : False). Commands are run one after
+            another in subshells, so ``cd`` or ``exit`` in a command does not affect the others.
+            ``cmd_timeout`` and ``workers`` are not used : the whole batch must be done within
+            ``total_timeout``. ``max_output`` is for the whole batch output.
 
     Returns:
 
@@ -298,21 +926,54 @@ def mrunsh(cmds, context = {},cmd_timeout = 30, total_timeout = 60, expected_pat
 
         Command execution returns **ONLY** stdout. If you want to get stderr, you need to redirect it to stdout.
 
+    Note:
+
+        When ``workers`` is greater than 1, all commands are executed, then a
+        :class:`ParallelCollectError` is raised if some of them have failed : its ``errors``
+        attribute gives the error of each failed command key and its ``results`` attribute
+        the results of the other commands.
+
     Examples:
 
-        >>> mrunsh({'now':'LANG=C date','quisuisje':'whoami'})
+        >>> mrunsh({'now':'LANG=C date','quisuisje':'whoami'})  #doctest: +SKIP
         {'now': ['Wed Dec 16 11:50:08 CET 2015'], 'quisuisje': ['elapouya']}
 
+        >>> mrunsh({'now':'LANG=C date','quisuisje':'whoami','pause':'sleep 1;echo done'},workers=3)  #doctest: +SKIP
+        {'now': ['Wed Dec 16 11:50:08 CET 2015'], 'quisuisje': ['elapouya'], 'pause': ['done']}
+
     """
-    with Timeout(seconds=total_timeout, error_message='Timeout (%ss) for mrunsh commands : %s' % (total_timeout,cmds)):
+    total_error = 'Timeout (%ss) for mrunsh commands : %s' % (total_timeout,cmds)
+    if isinstance(cmds,dict):
+        cmds = cmds.items()
+    if batch:
+        with Timeout(seconds=total_timeout, error_message=total_error):
+            cmd_list = [ cmd for k,cmd in cmds ]
+            collect = lambda: _run_batch(cmd_list, context, *limit_timeout_error(total_timeout, total_error), max_output=max_output)
+            results = _cached_collect(cache_ttl, ('localbatch',socket.gethostname(),cmd_list,context), collect)
+            dct = textops.DictExt()
+            for (k,cmd),(stdout,stderr,rcode) in zip(cmds,results):
+                result = textops.ListExt(stdout.splitlines())
+                dct[k] = _filter_result(result, k, cmd, expected_pattern, unexpected_pattern, filter)
+            return dct
+    if workers > 1:
+        tasks = [ (k,lambda k=k,cmd=cmd: runsh(cmd, context, cmd_timeout, expected_pattern, unexpected_pattern, filter, k, max_output, cache_ttl))
+                  for k,cmd in cmds ]
+        dct = textops.DictExt()
+        errors = []
+        for k,result,error in _run_parallel(tasks, workers, total_timeout, total_error):
+            if error is not None:
+                errors.append((k,error))
+            else:
+                dct[k] = result
+        _check_parallel_errors(errors, dct)
+        return dct
+    with Timeout(seconds=total_timeout, error_message=total_error):
         dct = textops.DictExt()
-        if isinstance(cmds,dict):
-            cmds = cmds.items()
         for k,cmd in cmds:
-            dct[k] = runsh(cmd, context, cmd_timeout, expected_pattern, unexpected_pattern, filter, k)
+            dct[k] = runsh(cmd, context, cmd_timeout, expected_pattern, unexpected_pattern, filter, k, max_output, cache_ttl)
         return dct
 
-def mrunshex(cmds, context = {},cmd_timeout = 30, total_timeout = 60, expected_pattern=r'\S', unexpected_pattern=None, filter=None,unexpected_stderr=True):
+def mrunshex(cmds, context = {},cmd_timeout = 30, total_timeout = 60, expected_pattern=r'\S', unexpected_pattern=None, filter=None,unexpected_stderr=True, workers=1, max_output=None, cache_ttl=None, batch=False):
     r"""Run multiple local commands with timeouts
 
     It works like :func:`runshex` except that one must provide a dictionary of commands.
@@ -324,7 +985,8 @@ def mrunshex(cmds, context = {},cmd_timeout = 30, total_timeout = 60, expected_p
 
         cmds (dict): dictionary where values are the commands to execute.
 
-            | If the command is a string, it will be executed within a shell.
+            | If the command is a string, it will be executed within a shell
+              (or directly if it is a simple command, see :data:`SHELL_FAST_PATH`).
             | If the command is a list (the command and its arguments), the command is executed without a shell.
             | If a context dict is specified, the command is formatted with that context (:meth:`str.format`)
 
@@ -343,6 +1005,18 @@ def mrunshex(cmds, context = {},cmd_timeout = 30, total_timeout = 60, expected_p
             ``mget`` and ``mwalk``.
             By Default, there is no filter.
         unexpected_stderr (bool): When True (Default), it raises an error if stderr is not empty
+        workers (int): The number of commands to run at the same time (Default : 1, that is
+            commands are run one after another). Each command still has its own ``cmd_timeout``
+            and the whole dictionary must be done within ``total_timeout``.
+        max_output (int): Maximum number of bytes to read from each command output
+            (Default : None = no limit, see :func:`runshex`).
+        cache_ttl (int): If set, each command output is stored in :data:`RESULT_CACHE` for
+            ``cache_ttl`` seconds (Default : None = no cache, see :func:`runsh`).
+        batch (bool): When True, all commands are sent as one script to a single shell process
+            instead of forking a shell per command (Default : False). Commands are run one after
+            another in subshells, so ``cd`` or ``exit`` in a command does not affect the others.
+            ``cmd_timeout`` and ``workers`` are not used : the whole batch must be done within
+            ``total_timeout``. ``max_output`` is for the whole batch output.
 
     Returns:
 
@@ -352,22 +1026,261 @@ def mrunshex(cmds, context = {},cmd_timeout = 30, total_timeout = 60, expected_p
 
         Command execution returns **ONLY** stdout. If you want to get stderr, you need to redirect it to stdout.
 
+    Note:
+
+        When ``workers`` is greater than 1, all commands are executed, then a
+        :class:`ParallelCollectError` is raised if some of them have failed : its ``errors``
+        attribute gives the error of each failed command key and its ``results`` attribute
+        the results of the other commands.
+
     Examples:
 
-        >>> mrunsh({'now':'LANG=C date','quisuisje':'whoami'})
+        >>> mrunsh({'now':'LANG=C date','quisuisje':'whoami'})  #doctest: +SKIP
         {'now': ['Wed Dec 16 11:50:08 CET 2015'], 'quisuisje': ['elapouya']}
 
     """
-    with Timeout(seconds=total_timeout, error_message='Timeout (%ss) for mrunsh commands : %s' % (total_timeout,cmds)):
+    total_error = 'Timeout (%ss) for mrunsh commands : %s' % (total_timeout,cmds)
+    if isinstance(cmds,dict):
+        cmds = cmds.items()
+    if batch:
+        with Timeout(seconds=total_timeout, error_message=total_error):
+            cmd_list = [ cmd for k,cmd in cmds ]
+            collect = lambda: _run_batch(cmd_list, context, *limit_timeout_error(total_timeout, total_error), max_output=max_output)
+            results = _cached_collect(cache_ttl, ('localbatchex',socket.gethostname(),cmd_list,context), collect)
+            dct = textops.DictExt()
+            for (k,cmd),(stdout,stderr,rcode) in zip(cmds,results):
+                if unexpected_stderr and stderr:
+                    _raise_unexpected_result(stderr, k, cmd, help_str='<stderr> returned :')
+                dct[k] = _filter_result(stdout, k, cmd, expected_pattern, unexpected_pattern, filter)
+                dct[k+'_stderr'] = stderr
+                dct[k+'_rcode'] = rcode
+            return dct
+    if workers > 1:
+        tasks = [ (k,lambda k=k,cmd=cmd: runshex(cmd, context, cmd_timeout, expected_pattern, unexpected_pattern, filter, k, unexpected_stderr, max_output, cache_ttl))
+                  for k,cmd in cmds ]
+        dct = textops.DictExt()
+        errors = []
+        for k,result,error in _run_parallel(tasks, workers, total_timeout, total_error):
+            if error is not None:
+                errors.append((k,error))
+            else:
+                dct[k],dct[k+'_stderr'],dct[k+'_rcode'] = result
+        _check_parallel_errors(errors, dct)
+        return dct
+    with Timeout(seconds=total_timeout, error_message=total_error):
         dct = textops.DictExt()
-        if isinstance(cmds,dict):
-            cmds = cmds.items()
         for k,cmd in cmds:
-            dct[k],dct[k+'_stderr'],dct[k+'_rcode'] = runshex(cmd, context, cmd_timeout, expected_pattern, unexpected_pattern, filter, k,unexpected_stderr)
+            dct[k],dct[k+'_stderr'],dct[k+'_rcode'] = runshex(cmd, context, cmd_timeout, expected_pattern, unexpected_pattern, filter, k, unexpected_stderr, max_output, cache_ttl)
         return dct
 
+class PromptScanner(object):
+    r"""Incremental prompt search in an interactive shell output
+
+    Data is given chunk by chunk with :meth:`feed` as it is read from the connection. Instead of
+    searching the prompt in the whole output each time, only the new data plus ``overlap``
+    bytes of the previous data are scanned : the scan time stays linear with the output size.
+
+    Patterns are tested in the list order : the first one that matches is used.
+
+    Args:
+
+        patterns (str or regex or list): The prompt pattern or a list of patterns
+        max_output (int): Maximum number of bytes to keep (Default : None = no limit). Above
+            that, the output is truncated and :data:`TRUNCATED_MARKER` is added, the prompt is
+            still searched in the following data.
+        overlap (int): Number of already scanned bytes to scan again with new data, it must be
+            greater than the prompt length (Default : 1024)
+
+    Attributes:
+
+        pat_id (int): The index of the pattern that matched or -1
+        match: The match object (positions are relative to the scanned window)
+        before (str): The output before the prompt
+        after (str): The prompt found
+        rest (str): The data read after the prompt
+
+    Examples:
+
+        >>> scanner = PromptScanner(r'[\r\n]\$ ')
+        >>> scanner.feed('ls\nfile1\nfi')
+        False
+        >>> scanner.feed('le2\n$ ')
+        True
+        >>> print scanner.before
+        ls
+        file1
+        file2
+        >>> scanner = PromptScanner(r'[\r\n]\$ ', max_output=10, overlap=10)
+        >>> scanner.feed('1234567890' * 200)
+        False
+        >>> scanner.feed('\n$ ')
+        True
+        >>> scanner.before
+        '1234567890\n<output truncated>\n1234567890'
+    """
+    def __init__(self, patterns, max_output=None, overlap=1024):
+        if not isinstance(patterns, (list,tuple)):
+            patterns = [ patterns ]
+        self.patterns = [ re.compile(pat) if isinstance(pat, basestring) else pat for pat in patterns ]
+        self.max_output = max_output
+        self.overlap = overlap
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.head = None
+        self.pat_id = -1
+        self.match = None
+        self.before = self.after = self.rest = ''
+
+    def _get_output(self, data):
+        if self.head is None:
+            return data
+        return '%s\n%s\n%s' % (self.head, TRUNCATED_MARKER, data[-self.overlap:])
+
+    def feed(self, data):
+        """Add data and search the prompt
+
+        Args:
+
+            data (str): Data read from the connection
+
+        Returns:
+
+            bool: True if the prompt has been found
+        """
+        self.buffer.extend(data)
+        start = max(self.scanned - self.overlap, 0)
+        window = str(self.buffer[start:])
+        for i,pat in enumerate(self.patterns):
+            m = pat.search(window)
+            if m:
+                self.pat_id = i
+                self.match = m
+                self.before = self._get_output(str(self.buffer[:start + m.start()]))
+                self.after = m.group(0)
+                self.rest = window[m.end():]
+                return True
+        self.scanned = len(self.buffer)
+        if self.max_output and len(self.buffer) > self.max_output + self.overlap:
+            # keep only the data needed to find a prompt spanning on the next chunk
+            if self.head is None:
+                self.head = str(self.buffer[:self.max_output])
+            del self.buffer[:-self.overlap]
+            self.scanned = len(self.buffer)
+        return False
+
+    def get_text(self):
+        """Returns the output with the prompt, like ``telnetlib.Telnet.expect()`` does"""
+        return self.before + self.after
+
 def debug_pattern_list(pat_list):
-    return [ (pat if isinstance(pat,basestring) else pat.pattern) for pat in pat_list ]
+    return [ (pat if isinstance(pat,basestring) else getattr(pat,'pattern',pat)) for pat in pat_list ]
+
+def _strip_cmd_echo(out, cmd):
+    # the command is searched as a plain string : it may contain regex special chars
+    if cmd:
+        pos = out.find(cmd)
+        if pos >= 0:
+            out = out[pos + len(cmd):].lstrip('\n')
+    return out
+
+class ExpectSteps(object):
+    r"""Compiled login/logout steps for :class:`Expect`
+
+    The steps definition (see :class:`Expect`) is normalized and all patterns are compiled once :
+    for each step, the pexpect compiled pattern list holds the step patterns followed by the next step
+    patterns. Compiled steps are cached at class level, so using the same ``login_steps`` in many
+    :class:`Expect` objects compiles them only once. Use :meth:`get` to benefit from the cache.
+
+    Args:
+
+        steps (tuple): The steps definition
+
+    Examples:
+
+        >>> steps = ExpectSteps.get(((r'(?i)Login: ','{user}\n'),(r'(?i)Password: ','{passwd}\n'),(r'^\$ ',None)))
+        >>> len(steps)
+        3
+        >>> [ p.pattern for p in steps[0].patterns ]
+        ['(?i)Login: ', '(?i)Password: ']
+        >>> steps[0].nb_base_expects
+        1
+        >>> steps[2].patterns[0].pattern
+        '[\r\n]\\$ '
+        >>> ExpectSteps.get(((r'(?i)Login: ','{user}\n'),(r'(?i)Password: ','{passwd}\n'),(r'^\$ ',None))) is steps
+        True
+    """
+    cache = {}
+    cache_size = 256
+
+    class Step(object):
+        def __init__(self, expects, nb_base_expects, patterns):
+            self.expects = expects
+            self.nb_base_expects = nb_base_expects
+            self.patterns = patterns
+            self.debug_patterns = debug_pattern_list(patterns)
+
+    def __init__(self, steps):
+        global pexpect
+        import pexpect
+        steps = [ self._normalize(expects) for expects in steps ]
+        self.steps = []
+        for i,expects in enumerate(steps):
+            nb_base_expects = len(expects)
+            if nb_base_expects == 1 and expects[0][0] is None:
+                patterns = []
+            else:
+                if i+1 < len(steps):
+                    expects += steps[i+1]
+                patterns = [ self._compile_pattern(e[0]) for e in expects ]
+            self.steps.append(ExpectSteps.Step(expects, nb_base_expects, patterns))
+
+    @staticmethod
+    def _normalize(expects):
+        # transform tuple of string into tuple of tuples of string
+        if isinstance(expects[0],basestring) or expects[0] is None:
+            return (tuple(expects),)
+        return tuple(expects)
+
+    @staticmethod
+    def _compile_pattern(pat):
+        # same as pexpect compile_pattern_list() : a dot also matches a newline
+        if pat is None:
+            return pexpect.EOF
+        if isinstance(pat,basestring):
+            pat = re.compile(re.sub(r'^\^',r'[\r\n]',pat), re.DOTALL)
+        return pat
+
+    @classmethod
+    def get(cls, steps):
+        """Returns the compiled steps from the cache, compiles them if needed
+
+        Args:
+
+            steps (tuple): The steps definition
+
+        Returns:
+
+            :class:`ExpectSteps`: The compiled steps
+        """
+        if isinstance(steps, ExpectSteps):
+            return steps
+        try:
+            compiled = cls.cache.get(steps)
+        except TypeError:
+            # not hashable (lists inside) : cannot be cached
+            return cls(steps)
+        if compiled is None:
+            compiled = cls(steps)
+            if len(cls.cache) >= cls.cache_size:
+                cls.cache.clear()
+            cls.cache[steps] = compiled
+        return compiled
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __getitem__(self, i):
+        return self.steps[i]
 
 class Expect(object):
     r"""Interact with a spawn command
@@ -398,6 +1311,8 @@ class Expect(object):
             that generated the ``result`` and ``key`` the key in the dictionary for ``mrun``,
             ``mget`` and ``mwalk``.
             By Default, there is no filter.
+        max_output (int): Maximum number of bytes to keep from a command output (Default : None =
+            no limit). Above that, the output is truncated and :data:`TRUNCATED_MARKER` is added.
 
     On object creation, :class:`Expect` will :
 
@@ -487,7 +1402,7 @@ class Expect(object):
 
     def __init__(self,spawn,login_steps=None,prompt=None,logout_cmd=None,logout_steps=None,context={},
                  timeout = 30, expected_pattern=r'\S', unexpected_pattern=r'<timeout>',
-                 filter=None,*args,**kwargs):
+                 filter=None, max_output=None, *args,**kwargs):
 
         self.expected_pattern = expected_pattern
         self.unexpected_pattern = unexpected_pattern
@@ -508,8 +1423,9 @@ class Expect(object):
         self.in_with = False
         self.is_connected = False
         naghelp.logger.debug('collect -> #### Expect( %s ) ###############',spawn)
-        with Timeout(seconds = timeout, error_message='Timeout (%ss) for pexpect : %s' % (timeout,spawn)):
-            self.child = pexpect.spawn(spawn)
+        timeout, error_message = limit_timeout_error(timeout, 'Timeout (%ss) for pexpect : %s' % (timeout,spawn))
+        with Timeout(seconds = timeout, error_message=error_message):
+            self.child = pexpect.spawn(spawn,timeout=timeout)
             if login_steps or prompt:
                 naghelp.logger.debug('collect -> ==== Login steps up to the prompt =====')
                 error_msg = self._expect_steps( (login_steps or ()) + ( ((prompt,None),) if prompt else () ) )
@@ -524,33 +1440,28 @@ class Expect(object):
         return pat
 
     def _expect_steps(self,steps):
+        steps = ExpectSteps.get(steps)
         step = 0
         nb_steps = len(steps)
         infinite_loop_detect = 0
         while step < nb_steps:
             naghelp.logger.debug('collect -> --------- STEP #%s--------------------------',step)
-            expects = steps[step]
-            # normalizing : transform tuple of string into tuple of tuples of string
-            if isinstance(expects[0],basestring):
-                expects = (expects,)
-            nb_base_expects = len(expects)
-            if nb_base_expects == 1 and expects[0][0] is None:
+            expects = steps[step].expects
+            nb_base_expects = steps[step].nb_base_expects
+            patterns = steps[step].patterns
+            debug_patterns = steps[step].debug_patterns
+            if not patterns:
                 found = 0
-                patterns = []
             else:
-                if step+1 < nb_steps:
-                    next_expects = steps[step+1]
-                    if isinstance(next_expects[0],basestring):
-                        next_expects = (next_expects,)
-                    expects += next_expects
-                patterns = [ self._expect_pattern_rewrite(e[0]) for e in expects ]
-                naghelp.logger.debug('collect -> <-- expect(%s) ...',patterns)
+                naghelp.logger.debug('collect -> <-- expect(%s) ...',debug_patterns)
                 try:
-                    found = self.child.expect(patterns)
+                    found = self.child.expect_list(patterns)
                 except pexpect.EOF:
                     naghelp.logger.debug('CollectError : No more data (EOF) from %s' % self.spawn)
                     raise CollectError('No more data (EOF) from %s' % self.spawn)
-                naghelp.logger.debug('collect ->   --> found : "%s"',patterns[found])
+                except pexpect.TIMEOUT:
+                    raise TimeoutError('Timeout while expecting %s' % debug_patterns)
+                naghelp.logger.debug('collect ->   --> found : "%s"',debug_patterns[found])
             to_send = expects[found][1]
             if to_send is not None:
                 if isinstance(to_send,basestring):
@@ -575,10 +1486,13 @@ class Expect(object):
                 infinite_loop_detect = 0
                 if step == nb_steps - 1:
                     break
+            elif step == nb_steps - 1 and to_send is None:
+                # only one step (ie : just the prompt) : there is no next step to wait for
+                break
             infinite_loop_detect += 1
             if infinite_loop_detect > 10:
-                naghelp.logger.debug('Too many expect for %s',patterns)
-                raise CollectError('Too many expect for %s' % patterns)
+                naghelp.logger.debug('Too many expect for %s',debug_patterns)
+                raise CollectError('Too many expect for %s' % debug_patterns)
 
         naghelp.logger.debug('collect -> FINISHED steps')
         return ''
@@ -604,7 +1518,24 @@ class Expect(object):
                 pass
             naghelp.logger.debug('collect -> #### Expect : Connection closed ###############')
 
-    def _run_cmd(self,cmd):
+    def _read_to_prompt(self,prompt,timeout=None):
+        if timeout is None:
+            timeout = self.child.timeout
+        deadline = monotonic() + timeout
+        scanner = PromptScanner(prompt, self.max_output)
+        data = self.child.buffer
+        while not scanner.feed(data):
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                raise pexpect.TIMEOUT('Timeout while waiting the prompt')
+            data = self.child.read_nonblocking(65536, remaining)
+        # data read after the prompt is given back to pexpect for the next expect() calls
+        self.child.buffer = scanner.rest
+        self.child.before = scanner.before
+        self.child.after = scanner.after
+        return scanner.before
+
+    def _run_cmd(self,cmd,timeout=None):
         if cmd:
             naghelp.logger.debug('collect -> run("%s") %s',cmd,naghelp.debug_caller())
             self.child.sendline('%s' % cmd)
@@ -612,14 +1543,17 @@ class Expect(object):
         prompt = self._expect_pattern_rewrite(self.prompt)
         naghelp.logger.debug('collect ->     expect prompt : %s',prompt)
         try:
-            self.child.expect(prompt)
+            if prompt is pexpect.EOF:
+                self.child.expect(prompt,timeout=timeout)
+                out = self.child.before
+            else:
+                out = self._read_to_prompt(prompt,timeout)
         except pexpect.EOF:
             naghelp.logger.debug('CollectError : No more data (EOF) from %s' % self.spawn)
             raise CollectError('No more data (EOF) from %s' % self.spawn)
-        out = self.child.before
-        # use re.compile to be compatible with python 2.6 (flags in re.sub only for python 2.7+)
-        rmcmd = re.compile(r'^.*?%s\n*' % cmd, re.DOTALL)
-        out = rmcmd.sub('', out)
+        except pexpect.TIMEOUT:
+            raise TimeoutError('Timeout (%ss) while waiting the prompt' % timeout)
+        out = _strip_cmd_echo(out, cmd)
         out = re.sub(r'[\r\n]*$', '', out)
         out = out.replace('\r','')
         return out
@@ -683,8 +1617,9 @@ class Expect(object):
             raise NotConnected('No expect connection to run your command.')
         out = None
         try:
+            timeout = limit_timeout(timeout)
             with Timeout(seconds = timeout):
-                out = self._run_cmd(cmd)
+                out = self._run_cmd(cmd,timeout)
         except TimeoutError:
             out = '<timeout>'
         if auto_close:
@@ -751,8 +1686,9 @@ class Expect(object):
             cmds = cmds.items()
         for k,cmd in cmds:
             try:
-                with Timeout(seconds = timeout):
-                    output = self._run_cmd(cmd)
+                cmd_timeout = limit_timeout(timeout)
+                with Timeout(seconds = cmd_timeout):
+                    output = self._run_cmd(cmd,cmd_timeout)
                     if k:
                         dct[k] = _filter_result(output,k,cmd, expected_pattern if expected_pattern != 0 else self.expected_pattern,
                                                          unexpected_pattern if unexpected_pattern != 0 else self.unexpected_pattern,
@@ -789,8 +1725,12 @@ class Telnet(object):
         autherr_pattern (str): The pattern to recognize authentication error
             (Default : ``bad password|login incorrect|login failed|authentication error``).
             One can specify a string or a re.RegexObject.
-        sleep (int): Add delay in seconds before each write/expect
-        sleep_login (int): Add delay in seconds before login
+        sleep (float): Minimum delay in seconds between two writes to the device, for devices
+            that loose characters when they receive them too quickly (Default : 0). Login and
+            commands are event-driven : data is sent as soon as the expected pattern is
+            received, there is no fixed delay anymore.
+        sleep_login (float): Minimum delay in seconds between the connection and the user name
+            write (Default : 0)
         expected_pattern (str or regex): raise UnexpectedResultError if the pattern is not found
             in methods that collect data (like run,mrun,get,mget,walk,mwalk...)
             if None, there is no test. By default, tests the result is not empty.
@@ -803,22 +1743,34 @@ class Telnet(object):
             that generated the ``result`` and ``key`` the key in the dictionary for ``mrun``,
             ``mget`` and ``mwalk``.
             By Default, there is no filter.
+        cache_ttl (int): If set, command outputs are stored in :data:`RESULT_CACHE` for
+            ``cache_ttl`` seconds and shared with other plugin processes (Default : None = no cache).
+            In this case, the connection is done only when a command output is not in the cache.
+        max_output (int): Maximum number of bytes to keep from a command output (Default : None =
+            no limit). Above that, the output is truncated and :data:`TRUNCATED_MARKER` is added.
     """
     def __init__(self,host, user, password=None, timeout=30, port=0,
                  login_pattern=None, passwd_pattern=None, prompt_pattern=None, autherr_pattern=None,
                  sleep=0, sleep_login=0, expected_pattern=r'\S', unexpected_pattern=r'<timeout>',
-                 filter=None, *args,**kwargs):
-        #import is done only on demand, because it takes some little time
-        import telnetlib
+                 filter=None, cache_ttl=None, max_output=None, *args,**kwargs):
         self.in_with = False
         self.is_connected = False
+        self.is_logged_in = False
+        self.tn = None
+        self.pending = ''
         self.prompt = None
         self.sleep = sleep
-        login_pattern = Telnet._normalize_pattern(login_pattern, r'login\s*:')
-        passwd_pattern = Telnet._normalize_pattern(passwd_pattern, r'Password\s*:')
-        prompt_pattern = Telnet._normalize_pattern(prompt_pattern, r'[\r\n][^\s]*\s?[\$#>:]+\s')
-        autherr_pattern = Telnet._normalize_pattern(autherr_pattern, r'bad password|login incorrect|login failed|authentication error')
-        self.prompt_pattern = prompt_pattern
+        self.sleep_login = sleep_login
+        self.last_write = 0
+        self.timeout = timeout
+        self.port = port
+        self.kwargs = kwargs
+        self.cache_ttl = cache_ttl
+        self.max_output = max_output
+        self.login_pattern = Telnet._normalize_pattern(login_pattern, r'login\s*:')
+        self.passwd_pattern = Telnet._normalize_pattern(passwd_pattern, r'Password\s*:')
+        self.prompt_pattern = Telnet._normalize_pattern(prompt_pattern, r'[\r\n][^\s]*\s?[\$#>:]+\s')
+        self.autherr_pattern = Telnet._normalize_pattern(autherr_pattern, r'bad password|login incorrect|login failed|authentication error')
         self.expected_pattern = expected_pattern
         self.unexpected_pattern = unexpected_pattern
         self.filter = filter
@@ -830,37 +1782,96 @@ class Telnet(object):
             raise ConnectionError('No host specified for Telnet')
         if not user:
             raise ConnectionError('No user specified for Telnet')
+        self.host = host
+        self.user = user
+        self.password = password
         naghelp.logger.debug('collect -> #### Telnet( %s@%s ) ###############',user, host)
-        with Timeout(seconds = timeout, error_message='Timeout (%ss) for telnet to %s' % (timeout,host)):
+        if cache_ttl:
+            # connection is done only when a result is not in the cache
+            self.is_connected = True
+        else:
+            self._connect()
+
+    def _connect(self):
+        #import is done only on demand, because it takes some little time
+        import telnetlib
+        timeout, error_message = limit_timeout_error(self.timeout, 'Timeout (%ss) for telnet to %s' % (self.timeout,self.host))
+        with Timeout(seconds = timeout, error_message=error_message):
+            start = monotonic()
             try:
-                self.tn = telnetlib.Telnet(host,port,timeout,**kwargs)
+                self.tn = telnetlib.Telnet(self.host,self.port,timeout,**self.kwargs)
+                self.pending = ''
                 #self.tn.set_debuglevel(1)
             except Exception,e:
                 raise ConnectionError(e)
-            naghelp.logger.debug('collect -> <-- expect(%s) ...',debug_pattern_list(login_pattern))
-            time.sleep(sleep_login or sleep)
-            self.tn.expect(login_pattern)
-            naghelp.logger.debug('collect ->   ==> %s',user)
-            time.sleep(sleep)
-            self.tn.write(user + "\n")
-            naghelp.logger.debug('collect -> <-- expect(%s) ...',debug_pattern_list(passwd_pattern))
-            if password is not None:
-                time.sleep(sleep)
-                self.tn.expect(passwd_pattern)
-                naghelp.logger.debug('collect ->   ==> (hidden password)')
-                time.sleep(sleep)
-                self.tn.write(password + "\n")
-            naghelp.logger.debug('collect -> <-- expect(%s) ...',debug_pattern_list(prompt_pattern + autherr_pattern))
-            time.sleep(sleep)
-            pat_id,m,buffer = self.tn.expect(prompt_pattern + autherr_pattern)
-            naghelp.logger.debug('collect -> pat_id,m,buffer = %s, %s, %s',pat_id,m,buffer)
-            if pat_id < 0:
-                raise ConnectionError('No regular prompt found.')
-            if pat_id >= len(prompt_pattern):
-                raise ConnectionError('Authentication error')
-            naghelp.logger.debug('collect -> Prompt found : is_connected = True')
+            naghelp.logger.debug('collect -> connected in %.3fs',monotonic() - start)
+            # pacing for the user name write
+            self.last_write = monotonic() + self.sleep_login - self.sleep
+            self._login(start + timeout, error_message)
+            naghelp.logger.debug('collect -> Prompt found : is_connected = True (login in %.3fs)',monotonic() - start)
+            self.is_logged_in = True
             self.is_connected = True
 
+    def _login(self, deadline, error_message):
+        # each state waits for its patterns and reacts as soon as one is received
+        states = [ ('login', self.login_pattern, self.user) ]
+        if self.password is not None:
+            states.append(('password', self.passwd_pattern, self.password))
+        states.append(('prompt', self.prompt_pattern + self.autherr_pattern, None))
+        for state, patterns, to_send in states:
+            naghelp.logger.debug('collect -> <-- expect(%s) ...',debug_pattern_list(patterns))
+            start = monotonic()
+            scanner = self._read_to_prompt(max(deadline - start,0.001), patterns)
+            naghelp.logger.debug('collect ->   --> %s pattern id = %s after %.3fs : %r',
+                                 state, scanner.pat_id, monotonic() - start, scanner.after)
+            if scanner.pat_id < 0:
+                if state == 'prompt':
+                    raise ConnectionError('No regular prompt found.')
+                raise TimeoutError(error_message)
+            if to_send is not None:
+                naghelp.logger.debug('collect ->   ==> %s', '(hidden password)' if state == 'password' else to_send)
+                self._write(to_send + '\n')
+        if scanner.pat_id >= len(self.prompt_pattern):
+            raise ConnectionError('Authentication error')
+
+    def _write(self, data):
+        if self.sleep:
+            wait = self.last_write + self.sleep - monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        self.tn.write(data)
+        self.last_write = monotonic()
+
+    def _run_batch(self,cmds,timeout):
+        # runs all commands with a single shell script line, returns the outputs list
+        naghelp.logger.debug('collect -> run batch %s %s',cmds,naghelp.debug_caller())
+        marker = _new_batch_marker()
+        deadline = monotonic() + timeout
+        self._write('%s\n' % _build_batch_script(cmds, None, marker, interactive=True))
+        scanner = self._read_to_prompt(timeout,[_get_batch_end_pattern(marker, len(cmds))])
+        if scanner.pat_id < 0:
+            raise TimeoutError('Timeout (%ss) while waiting the batch end' % timeout)
+        if self._read_to_prompt(max(deadline - monotonic(),0.001)).pat_id < 0:
+            raise TimeoutError('Timeout (%ss) while waiting the prompt' % timeout)
+        outs = _split_interactive_batch_output(scanner.get_text(), marker, len(cmds))
+        for out in outs:
+            naghelp.debug_listing(out)
+        return outs
+
+    def _collect_batch(self,cmds,timeout):
+        def collect():
+            if not self.is_logged_in:
+                self._connect()
+            return self._run_batch(cmds,timeout)
+        return _cached_collect(self.cache_ttl, ('telnetbatch',self.host,self.port,self.user,cmds), collect)
+
+    def _collect_cmd(self,cmd,timeout):
+        def collect():
+            if not self.is_logged_in:
+                self._connect()
+            return self._run_cmd(cmd,timeout)
+        return _cached_collect(self.cache_ttl, ('telnet',self.host,self.port,self.user,cmd), collect)
+
     @staticmethod
     def _normalize_pattern(pattern,default):
         if pattern is None:
@@ -881,23 +1892,47 @@ class Telnet(object):
 
     def close(self):
         if not self.in_with:
-            self.tn.close()
+            if self.tn is not None:
+                self.tn.close()
             self.is_connected = False
+            self.is_logged_in = False
             naghelp.logger.debug('collect -> #### Telnet : Connection closed ###############')
 
-    def _run_cmd(self,cmd):
+    def _read_to_prompt(self,timeout,patterns=None):
+        # like telnetlib.Telnet.expect() but with an incremental prompt search
+        deadline = monotonic() + (timeout or 0)
+        scanner = PromptScanner(patterns or self.prompt_pattern, self.max_output)
+        tn = self.tn
+        data, self.pending = self.pending, ''
+        while True:
+            if scanner.feed(data):
+                # data received after the prompt is kept for the next read
+                self.pending = scanner.rest
+                return scanner
+            remaining = deadline - monotonic() if timeout else None
+            if remaining is not None and remaining <= 0:
+                return scanner
+            try:
+                select.select([tn.get_socket()],[],[],remaining)
+            except select.error,e:
+                if e[0] != errno.EINTR:
+                    raise
+            try:
+                data = tn.read_very_eager()
+            except EOFError:
+                return scanner
+
+    def _run_cmd(self,cmd,timeout=None):
         if isinstance(cmd, unicode):
             cmd = cmd.encode('utf-8','ignore')
         naghelp.logger.debug('collect -> run("%s") %s',cmd,naghelp.debug_caller())
-        time.sleep(self.sleep)
-        self.tn.write('%s\n' % cmd)
+        self._write('%s\n' % cmd)
         naghelp.logger.debug('collect -> <-- expect(%s) ...',debug_pattern_list(self.prompt_pattern))
-        time.sleep(self.sleep)
-        pat_id,m,buffer = self.tn.expect(self.prompt_pattern)
-        out = buffer.replace('\r','')
-        # use re.compile to be compatible with python 2.6 (flags in re.sub only for python 2.7+)
-        rmcmd = re.compile(r'^.*?%s\n*' % cmd, re.DOTALL)
-        out = rmcmd.sub('', out)
+        scanner = self._read_to_prompt(timeout)
+        if scanner.pat_id < 0:
+            raise TimeoutError('Timeout (%ss) while waiting the prompt' % timeout)
+        out = scanner.get_text().replace('\r','')
+        out = _strip_cmd_echo(out, cmd)
         # remove cmd and prompt (first and last line)
         out = out.splitlines()[:-1]
         cmd_out = '\n'.join(out)
@@ -958,8 +1993,9 @@ class Telnet(object):
             raise NotConnected('No telnet connection to run your command.')
         out = ''
         try:
+            timeout = limit_timeout(timeout)
             with Timeout(seconds = timeout):
-                out = self._run_cmd(cmd)
+                out = self._collect_cmd(cmd,timeout)
         except TimeoutError:
             out = '<timeout>'
         if auto_close:
@@ -968,7 +2004,7 @@ class Telnet(object):
                                                          unexpected_pattern if unexpected_pattern != 0 else self.unexpected_pattern,
                                                          filter if filter != 0 else self.filter))
 
-    def mrun(self, cmds, timeout=30, auto_close=True, expected_pattern=0, unexpected_pattern=0, filter=0, **kwargs):
+    def mrun(self, cmds, timeout=30, auto_close=True, expected_pattern=0, unexpected_pattern=0, filter=0, batch=False, **kwargs):
         r"""Execute many commands at the same time
 
         Runs a dictionary of commands at the specified prompt and then close the connection.
@@ -992,6 +2028,11 @@ class Telnet(object):
                 that generated the ``result`` and ``key`` the key in the dictionary for ``mrun``,
                 ``mget`` and ``mwalk``.
                 By default, use the filter defined at object level.
+            batch (bool): When True, all commands are sent at once as a single shell command
+                line and the output is split back per command (Default : False). This saves one
+                network round trip and one prompt detection per command. The remote shell must
+                be a POSIX shell, each command is run in a subshell. The whole batch must be done
+                within ``timeout`` multiplied by the number of commands.
 
         Return:
 
@@ -1016,10 +2057,26 @@ class Telnet(object):
         dct = textops.DictExt()
         if isinstance(cmds,dict):
             cmds = cmds.items()
+        if batch and cmds:
+            try:
+                batch_timeout = limit_timeout(timeout * len(cmds))
+                with Timeout(seconds = batch_timeout):
+                    outs = self._collect_batch([ cmd for k,cmd in cmds ],batch_timeout)
+            except TimeoutError:
+                outs = [ '<timeout>' ] * len(cmds)
+            for (k,cmd),out in zip(cmds,outs):
+                if k:
+                    dct[k] = _filter_result(out,k,cmd, expected_pattern if expected_pattern != 0 else self.expected_pattern,
+                                                         unexpected_pattern if unexpected_pattern != 0 else self.unexpected_pattern,
+                                                         filter if filter != 0 else self.filter)
+            if auto_close:
+                self.close()
+            return dct
         for k,cmd in cmds:
             try:
-                with Timeout(seconds = timeout):
-                    output = self._run_cmd(cmd)
+                cmd_timeout = limit_timeout(timeout)
+                with Timeout(seconds = cmd_timeout):
+                    output = self._collect_cmd(cmd,cmd_timeout)
                     if k:
                         dct[k] = _filter_result(output,k,cmd, expected_pattern if expected_pattern != 0 else self.expected_pattern,
                                                          unexpected_pattern if unexpected_pattern != 0 else self.unexpected_pattern,
@@ -1077,15 +2134,46 @@ class Ssh(object):
         gss_host (str): The targets name in the kerberos database. default: hostname
         banner_timeout (float): an optional timeout (in seconds) to wait
             for the SSH banner to be presented.
+        cache_ttl (int): If set, command outputs are stored in :data:`RESULT_CACHE` for
+            ``cache_ttl`` seconds and shared with other plugin processes (Default : None = no cache).
+            In this case, the connection is done only when a command output is not in the cache.
+        use_broker (bool or str): If True or a unix socket path, commands are executed by the
+            local SSH broker (see :mod:`naghelp.sshbroker`) that keeps connections opened between
+            plugin executions (Default : False). The password is sent to the broker over its unix
+            socket. If the broker is not running, or if its socket or socket directory do not belong to
+            the user, the command is executed with a direct connection.
+            The broker is not used when ``prompt_pattern`` is set or with ``pkey`` or ``sock``
+            parameters.
+        start_broker (bool): With ``use_broker``, start the broker in background when it is not
+            running (Default : False, the broker must be started separately).
+        max_output (int): Maximum number of bytes to keep from a command output when
+            ``prompt_pattern`` is set (Default : None = no limit). Above that, the output is
+            truncated and :data:`TRUNCATED_MARKER` is added.
     """
     def __init__(self,host, user, password=None, timeout=30, auto_accept_new_host=True,
                  prompt_pattern=None, get_pty=False, expected_pattern=r'\S', unexpected_pattern=r'<timeout>',
-                 filter=None, add_stderr=True, *args,**kwargs):
+                 filter=None, add_stderr=True, cache_ttl=None, use_broker=False, start_broker=False, max_output=None, *args,**kwargs):
         #import is done only on demand, because it takes some little time
         import paramiko
         self.in_with = False
         self.is_connected = False
+        self.is_logged_in = False
+        self.host = host
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.kwargs = kwargs
+        self.cache_ttl = cache_ttl
+        self.max_output = max_output
+        self.auto_accept_new_host = auto_accept_new_host
+        self.connect_lock = threading.Lock()
+        self.broker = None
+        self.start_broker = start_broker
+        if use_broker and not prompt_pattern and set(kwargs).issubset(BROKER_CONNECT_KWARGS):
+            self.broker = use_broker if isinstance(use_broker, basestring) else SSH_BROKER_SOCKET
         self.prompt_pattern = prompt_pattern
+        if self.prompt_pattern:
+            self.prompt_pattern = re.compile(re.sub(r'^\^',r'[\r\n]',prompt_pattern))
         self.get_pty = get_pty
         self.expected_pattern = expected_pattern
         self.unexpected_pattern = unexpected_pattern
@@ -1100,18 +2188,85 @@ class Ssh(object):
             self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self.client.load_system_host_keys()
         naghelp.logger.debug('collect -> #### Ssh( %s@%s ) ###############',user, host)
+        if cache_ttl or self.broker:
+            # connection is done only when a result is not in the cache or not done by the broker
+            self.is_connected = True
+        else:
+            self._connect()
+
+    def _connect(self):
+        timeout = limit_timeout(self.timeout)
         try:
-            self.client.connect(host,username=user,password=password, timeout=timeout, **kwargs)
+            self.client.connect(self.host,username=self.user,password=self.password, timeout=timeout, **self.kwargs)
             if self.prompt_pattern:
-                self.prompt_pattern = re.compile(re.sub(r'^\^',r'[\r\n]',prompt_pattern))
                 self.chan = self.client.invoke_shell(width=160,height=48)
                 self.chan.settimeout(timeout)
                 self._read_to_prompt()
         except Exception,e:
             raise ConnectionError(e)
         naghelp.logger.debug('collect -> is_connected = True')
+        self.is_logged_in = True
         self.is_connected = True
 
+    def _ensure_connected(self):
+        with self.connect_lock:
+            if not self.is_logged_in:
+                self._connect()
+
+    def _broker_exec_cmd(self,cmd,timeout):
+        request = {'host':self.host, 'user':self.user, 'password':self.password, 'cmd':cmd,
+                   'timeout':timeout, 'get_pty':self.get_pty,
+                   'auto_accept_new_host':self.auto_accept_new_host, 'connect_kwargs':self.kwargs}
+        response = broker_exec(request, self.broker)
+        if response.get('error') == 'timeout':
+            raise socket.timeout(response['message'])
+        if response.get('error'):
+            raise ConnectionError(response['message'])
+        return response['out'], response['err']
+
+    def _exec_cmd(self,cmd,timeout):
+        # returns stdout and stderr of a command run with exec_command(), by the SSH broker if any
+        if self.broker and not self.is_logged_in:
+            try:
+                naghelp.logger.debug('collect -> using SSH broker %s',self.broker)
+                return self._broker_exec_cmd(cmd,timeout)
+            except BrokerUnavailable,e:
+                naghelp.logger.debug('collect -> %s : using a direct connection',e)
+                if self.start_broker:
+                    start_ssh_broker(self.broker)
+                self.broker = None
+        self._ensure_connected()
+        stdin, stdout, stderr = self.client.exec_command(cmd,timeout=timeout,get_pty=self.get_pty)
+        return stdout.read(), stderr.read()
+
+    def _collect_cmd(self,cmd,timeout):
+        return _cached_collect(self.cache_ttl, ('ssh',self.host,self.kwargs.get('port'),self.user,self.add_stderr,cmd),
+                               lambda: self._run_cmd(cmd,timeout))
+
+    def _run_batch(self,cmds,timeout):
+        # runs all commands with a single remote shell script, returns the outputs list
+        naghelp.logger.debug('collect -> run batch %s %s',cmds,naghelp.debug_caller())
+        marker = _new_batch_marker()
+        if self.prompt_pattern is None:
+            out, err = self._exec_cmd(_build_batch_script(cmds, None, marker, pty=self.get_pty), timeout)
+            outs = _split_batch_output(out, marker, len(cmds))
+            errs = _split_batch_output(err, marker, len(cmds))
+            outs = [ out + (err if self.add_stderr else '') for (out,rcode),(err,_) in zip(outs,errs) ]
+        else:
+            self._ensure_connected()
+            self.chan.settimeout(timeout)
+            self.chan.send('%s\n' % _build_batch_script(cmds, None, marker, interactive=True))
+            scanner = self._scan(_get_batch_end_pattern(marker, len(cmds)))
+            self._scan(self.prompt_pattern, scanner.rest)
+            outs = _split_interactive_batch_output(scanner.get_text(), marker, len(cmds))
+        for out in outs:
+            naghelp.debug_listing(out)
+        return outs
+
+    def _collect_batch(self,cmds,timeout):
+        return _cached_collect(self.cache_ttl, ('sshbatch',self.host,self.kwargs.get('port'),self.user,self.add_stderr,cmds),
+                               lambda: self._run_batch(cmds,timeout))
+
     def __enter__(self):
         self.in_with = True
         return self
@@ -1124,30 +2279,36 @@ class Ssh(object):
         if not self.in_with:
             self.client.close()
             self.is_connected = False
+            self.is_logged_in = False
             naghelp.logger.debug('collect -> #### Ssh : Connection closed ###############')
 
+    def _scan(self,pattern,data=''):
+        scanner = PromptScanner(pattern, self.max_output)
+        while not scanner.feed(data):
+            data = self.chan.recv(65536)
+            if not data:
+                raise CollectError('No more data (EOF) from %s' % self.host)
+        return scanner
+
     def _read_to_prompt(self):
-        buff = ''
-        while not self.prompt_pattern.search(buff):
-            buff += self.chan.recv(8192)
-        return buff
+        scanner = self._scan(self.prompt_pattern)
+        return scanner.get_text() + scanner.rest
 
     def _run_cmd(self,cmd,timeout):
         naghelp.logger.debug('collect -> run("%s") %s',cmd,naghelp.debug_caller())
         if self.prompt_pattern is None:
-            stdin, stdout, stderr = self.client.exec_command(cmd,timeout=timeout,get_pty=self.get_pty)
-            out = stdout.read()
+            out, err = self._exec_cmd(cmd,timeout)
             if self.add_stderr:
-                out += stderr.read()
+                out += err
             naghelp.debug_listing(out)
             return out
         else:
+            self._ensure_connected()
+            self.chan.settimeout(timeout)
             self.chan.send('%s\n' % cmd)
             out = self._read_to_prompt()
             out = out.replace('\r','')
-            # use re.compile to be compatible with python 2.6 (flags in re.sub only for python 2.7+)
-            rmcmd = re.compile(r'^.*?%s\n*' % cmd, re.DOTALL)
-            out = rmcmd.sub('', out)
+            out = _strip_cmd_echo(out, cmd)
             # remove cmd and prompt (first and last line)
             out = out.splitlines()[:-1]
             cmd_out = '\n'.join(out)
@@ -1200,7 +2361,7 @@ class Ssh(object):
         if not self.is_connected:
             raise NotConnected('No ssh connection to run your command.')
         try:
-            out = self._run_cmd(cmd,timeout=timeout)
+            out = self._collect_cmd(cmd,limit_timeout(timeout))
         except socket.timeout:
             out = '<timeout>'
         if auto_close:
@@ -1209,7 +2370,7 @@ class Ssh(object):
                                                          unexpected_pattern if unexpected_pattern != 0 else self.unexpected_pattern,
                                                          filter if filter != 0 else self.filter))
 
-    def mrun(self, cmds, timeout=30, auto_close=True, expected_pattern=0, unexpected_pattern=0, filter=0, **kwargs):
+    def mrun(self, cmds, timeout=30, auto_close=True, expected_pattern=0, unexpected_pattern=0, filter=0, workers=1, batch=False, **kwargs):
         r"""Execute many commands at the same time
 
         Runs a dictionary of commands at the specified prompt and then close the connection.
@@ -1233,6 +2394,17 @@ class Ssh(object):
                 that generated the ``result`` and ``key`` the key in the dictionary for ``mrun``,
                 ``mget`` and ``mwalk``.
                 By default, use the filter defined at object level.
+            workers (int): The number of commands to run at the same time, each one on its own
+                channel of the same connection (Default : 1, that is commands are run one after
+                another). It is not used when ``prompt_pattern`` is set. Note that OpenSSH
+                servers accept 10 channels per connection by default (``MaxSessions``).
+                All commands are run, then a :class:`ParallelCollectError` is raised if some
+                of them have failed (timeouts still give ``<timeout>``).
+            batch (bool): When True, all commands are sent at once as a single shell script
+                and the output is split back per command (Default : False). This saves one
+                network round trip per command. The remote shell must be a POSIX shell, each
+                command is run in a subshell. ``timeout`` is then the maximum time to wait for
+                some output, or for the whole batch with ``prompt_pattern``.
 
         Return:
 
@@ -1263,9 +2435,48 @@ class Ssh(object):
         dct = textops.DictExt()
         if isinstance(cmds,dict):
             cmds = cmds.items()
+        if batch and cmds:
+            try:
+                with Timeout(seconds = limit_timeout(timeout * len(cmds))):
+                    outs = self._collect_batch([ cmd for k,cmd in cmds ],limit_timeout(timeout))
+            except (socket.timeout,TimeoutError):
+                outs = [ '<timeout>' ] * len(cmds)
+            for (k,cmd),out in zip(cmds,outs):
+                if k:
+                    dct[k] = _filter_result(out,k,cmd, expected_pattern if expected_pattern != 0 else self.expected_pattern,
+                                                         unexpected_pattern if unexpected_pattern != 0 else self.unexpected_pattern,
+                                                         filter if filter != 0 else self.filter)
+            if auto_close:
+                self.close()
+            return dct
+        if workers > 1 and self.prompt_pattern is None:
+            # commands share the connection, each one has its own channel
+            timeout = limit_timeout(timeout)
+            rounds = (len(cmds) + workers - 1) // workers
+            tasks = [ (k,lambda cmd=cmd: self._collect_cmd(cmd,timeout)) for k,cmd in cmds ]
+            error_message = 'Timeout (%ss) for ssh commands on %s' % (timeout,self.host)
+            results = _run_parallel(tasks, workers, timeout * rounds, error_message)
+            errors = []
+            for (k,cmd),(key,out,error) in zip(cmds,results):
+                if isinstance(error,(socket.timeout,TimeoutError)):
+                    out = '<timeout>'
+                elif error is not None:
+                    errors.append((k or cmd,error))
+                    continue
+                if k:
+                    try:
+                        dct[k] = _filter_result(out,k,cmd, expected_pattern if expected_pattern != 0 else self.expected_pattern,
+                                                             unexpected_pattern if unexpected_pattern != 0 else self.unexpected_pattern,
+                                                             filter if filter != 0 else self.filter)
+                    except CollectError,e:
+                        errors.append((k,e))
+            if auto_close:
+                self.close()
+            _check_parallel_errors(errors, dct)
+            return dct
         for k,cmd in cmds:
             try:
-                out = self._run_cmd(cmd,timeout=timeout)
+                out = self._collect_cmd(cmd,limit_timeout(timeout))
                 if k:
                     dct[k] = _filter_result(out,k,cmd, expected_pattern if expected_pattern != 0 else self.expected_pattern,
                                                          unexpected_pattern if unexpected_pattern != 0 else self.unexpected_pattern,
@@ -1279,6 +2490,844 @@ class Ssh(object):
             self.close()
         return dct
 
+    def tail(self, path, data, key=None, timeout=30, max_size=None, from_start=False, auto_close=True):
+        r"""Get the lines appended to a remote file since the last call
+
+        Only the new bytes are transferred : the file inode and the offset already read are stored
+        in ``data`` (usually the :class:`~naghelp.Host` object, so they are saved as persistent
+        data with the host). A rotated file (inode changed) or a truncated file (size lower than
+        the offset) is read from the beginning. Lines written to a rotated file after the last
+        call are lost. An incomplete last line is not returned : it will be with the next call.
+        The remote host must have a POSIX shell, ``ls`` and ``tail`` commands.
+
+        Args:
+
+            path (str): The remote file path
+            data (dict): Where to store the file inode and offset between calls, usually the
+                :class:`~naghelp.Host` object.
+            key (str): The key to use in ``data`` (Default : ``tail_<path>``)
+            timeout (int): A timeout in seconds for the remote command
+            max_size (int): Maximum number of bytes to read at once (Default : None = no limit).
+                The remaining bytes will be read with the next call.
+            from_start (bool): When the file has never been read, return the whole file content.
+                If False (Default), only the lines appended after the first call will be returned.
+            auto_close (bool): Automatically close the connection.
+
+        Return:
+
+            :class:`textops.ListExt` : The new lines
+
+        Example:
+
+            In a plugin ``collect_data()`` method::
+
+                ssh = Ssh(self.host.ip,self.host.user,self.host.passwd)
+                new_lines = ssh.tail('/var/log/messages',self.host)
+                data.errors = new_lines.grepi('error')
+        """
+        if not self.is_connected:
+            raise NotConnected('No ssh connection to run your command.')
+        if self.prompt_pattern is not None:
+            raise CollectError('Ssh.tail() cannot be used with a prompt_pattern')
+        key = key or 'tail_%s' % path
+        state = data.get(key) or {}
+        inode = state.get('inode') or ''
+        offset = int(state.get('offset') or 0)
+        # decides on the remote side where to start reading to do only one round trip
+        cmd = ('l=$(ls -iLnd %(path)s) || exit 1; set -- $l; '
+               'if [ -z "%(inode)s" ]; then start=%(first_start)s; '
+               'elif [ "$1" != "%(inode)s" ] || [ "$6" -lt %(offset)s ]; then start=1; '
+               'else start=%(start)s; fi; '
+               'echo "$1 $6 $start"; '
+               'tail -c +$start %(path)s%(head)s') % {
+                    'path':pipes.quote(path), 'inode':inode, 'offset':offset, 'start':offset + 1,
+                    'first_start': 1 if from_start else '$(($6+1))',
+                    'head': ' | head -c %s' % int(max_size) if max_size else ''}
+        try:
+            out, err = self._exec_cmd(cmd,limit_timeout(timeout))
+        except socket.timeout:
+            raise TimeoutError('Timeout (%ss) for reading %s on %s' % (timeout,path,self.host))
+        finally:
+            if auto_close:
+                self.close()
+        header, sep, content = out.partition('\n')
+        try:
+            new_inode, size, start = header.split()
+            start = int(start)
+        except ValueError:
+            raise CollectError('Cannot read %s on %s : %s' % (path,self.host,err.strip() or header))
+        end = content.rfind('\n') + 1
+        if not end and max_size and len(content) >= max_size:
+            # a line bigger than max_size : do not get stuck on it
+            end = len(content)
+        data[key] = {'inode':new_inode, 'offset':start - 1 + end}
+        naghelp.logger.debug('collect -> tail(%s) : %s new bytes from offset %s',path,end,start - 1)
+        return textops.ListExt(content[:end].splitlines())
+
+class AsyncCollector(object):
+    r"""Base class for asynchronous collectors
+
+    An asynchronous collector wraps a blocking collector (:class:`Ssh`, :class:`Telnet` or
+    :class:`Expect`) : the connection, :meth:`run`, :meth:`mrun` and :meth:`close` are executed in
+    a shared thread pool (:data:`naghelp.COLLECTOR_POOL` by default) and return immediately a
+    :class:`naghelp.CollectFuture`. Calls on the same collector are executed one after another
+    in the order they were made, calls on different collectors run at the same time. This way,
+    one process can drive many device sessions at once.
+
+    Arguments are the same as the blocking collector, plus an optional ``pool`` argument to
+    use a specific :class:`naghelp.CollectorPool`. Connection errors are raised by the first
+    future asking for the result.
+    """
+    collector_class = None
+
+    def __init__(self, *args, **kwargs):
+        self.pool = kwargs.pop('pool', None) or COLLECTOR_POOL
+        self.collector = None
+        self._lock = threading.Lock()
+        self._pending = []
+        self._running = False
+        self.connection = self._submit(self._connect, args, kwargs)
+
+    def _connect(self, args, kwargs):
+        self.collector = self.collector_class(*args, **kwargs)
+        return self.collector
+
+    def _get_collector(self):
+        exception = self.connection.exception(0)
+        if exception is not None:
+            raise exception
+        return self.collector
+
+    def _submit(self, func, *args, **kwargs):
+        future = CollectFuture()
+        with self._lock:
+            self._pending.append((future, func, args, kwargs))
+            if self._running:
+                return future
+            self._running = True
+        self._run_next()
+        return future
+
+    def _run_next(self):
+        with self._lock:
+            if not self._pending:
+                self._running = False
+                return
+            task = self._pending.pop(0)
+        self.pool.submit(self._run_task, *task)
+
+    def _run_task(self, future, func, args, kwargs):
+        try:
+            result = func(*args, **kwargs)
+        except Exception,e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        finally:
+            self._run_next()
+
+    def _call(self, method, *args, **kwargs):
+        return getattr(self._get_collector(), method)(*args, **kwargs)
+
+    def call(self, method, *args, **kwargs):
+        """Call a method of the blocking collector in the pool
+
+        Args:
+
+            method (str): The blocking collector method name (ie : ``'tail'`` for :class:`AsyncSsh`)
+            *args: The method positional arguments
+            **kwargs: The method keyword arguments
+
+        Returns:
+
+            :class:`naghelp.CollectFuture`: The future method result
+        """
+        return self._submit(self._call, method, *args, **kwargs)
+
+    def run(self, *args, **kwargs):
+        """Same as the blocking collector ``run()`` but returns a :class:`naghelp.CollectFuture`"""
+        return self.call('run', *args, **kwargs)
+
+    def mrun(self, *args, **kwargs):
+        """Same as the blocking collector ``mrun()`` but returns a :class:`naghelp.CollectFuture`"""
+        return self.call('mrun', *args, **kwargs)
+
+    def close(self):
+        """Close the connection once the pending calls are done, returns a :class:`naghelp.CollectFuture`"""
+        return self.call('close')
+
+    def __enter__(self):
+        self.call('__enter__')
+        return self
+
+    def __exit__(self, type, value, traceback):
+        # wait the pending calls before leaving the block
+        self.call('__exit__', None, None, None).exception()
+
+class AsyncExpect(AsyncCollector):
+    r"""Asynchronous :class:`Expect`
+
+    See :class:`AsyncCollector`, arguments are the same as :class:`Expect`.
+
+    Example::
+
+        sessions = [ AsyncExpect('telnet %s' % host, login_steps=steps, prompt=r'\$ ') for host in hosts ]
+        futures = [ e.run('uptime') for e in sessions ]
+        for host, uptime in zip(hosts, gather_results(futures, timeout=60, return_exceptions=True)):
+            print host, uptime
+    """
+    collector_class = Expect
+
+class AsyncTelnet(AsyncCollector):
+    r"""Asynchronous :class:`Telnet`
+
+    See :class:`AsyncCollector`, arguments are the same as :class:`Telnet`.
+
+    Example::
+
+        sessions = [ AsyncTelnet(host,'www','wwwpassword') for host in hosts ]
+        futures = [ tn.mrun({'up':'uptime','df':'df -h'}) for tn in sessions ]
+        for host, future in zip(hosts, futures):
+            print host, future.result(60)
+    """
+    collector_class = Telnet
+
+class AsyncSsh(AsyncCollector):
+    r"""Asynchronous :class:`Ssh`
+
+    See :class:`AsyncCollector`, arguments are the same as :class:`Ssh`.
+
+    Example::
+
+        sessions = [ AsyncSsh(host,'www','wwwpassword') for host in hosts ]
+        futures = [ ssh.mrun({'up':'uptime','df':'df -h'}) for ssh in sessions ]
+        results = gather_results(futures, timeout=60, return_exceptions=True)
+    """
+    collector_class = Ssh
+
+MIB_CACHE_FILE = '/tmp/naghelp/mib_cache.json'
+"""The file where :class:`MibCache` stores the resolved MIB symbols"""
+
+class MibCache(object):
+    r"""On-disk cache of MIB symbols resolved into numeric OIDs
+
+    Resolving a ``(MIB, symbol, index)`` OID with pysnmp loads and compiles the MIB modules in every
+    plugin process. This cache stores the numeric OID of each ``MIB::symbol`` in a json file shared
+    by all plugins : next resolutions do not load the MIB machinery at all. An entry is resolved
+    again when the MIB module file it comes from has been modified.
+
+    Args:
+
+        filename (str): The cache file (Default : :data:`MIB_CACHE_FILE`)
+
+    Example::
+
+        >>> MIB_CACHE.resolve('SNMPv2-MIB', 'sysDescr', 0)
+        '1.3.6.1.2.1.1.1.0'
+    """
+    def __init__(self, filename=MIB_CACHE_FILE):
+        self.filename = filename
+        self.entries = None
+        self.mib_builder = None
+        self.mib_view = None
+
+    def _load(self):
+        try:
+            with open(self.filename) as fh:
+                self.entries = json.load(fh)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def _save(self):
+        try:
+            filedir = os.path.dirname(self.filename)
+            if not os.path.exists(filedir):
+                os.makedirs(filedir)
+            tmp_filename = '%s.%s' % (self.filename,os.getpid())
+            with open(tmp_filename,'w') as fh:
+                json.dump(self.entries,fh)
+            os.rename(tmp_filename,self.filename)
+        except (IOError, OSError),e:
+            naghelp.logger.debug('collect -> cannot save MIB cache %s : %s',self.filename,e)
+
+    def _is_valid(self, entry):
+        if entry.get('path') is None:
+            return True
+        try:
+            return os.path.getmtime(entry['path']) == entry['mtime']
+        except OSError:
+            return False
+
+    def _find_mib_file(self, mib):
+        for source in self.mib_builder.getMibSources():
+            for sfx in ('.py','.pyc'):
+                try:
+                    path = source.fullPath(mib,sfx)
+                except Exception:
+                    break
+                if os.path.isfile(path):
+                    return path
+        return None
+
+    def _resolve_with_mib(self, mib, symbol):
+        # the MIB machinery is imported and loaded only on cache misses
+        from pysnmp.smi import builder, view, error
+        from pysnmp.smi.rfc1902 import ObjectIdentity
+        if self.mib_view is None:
+            self.mib_builder = builder.MibBuilder()
+            self.mib_view = view.MibViewController(self.mib_builder)
+        try:
+            oid = ObjectIdentity(mib, symbol).resolveWithMib(self.mib_view).getOid()
+        except error.SmiError,e:
+            raise CollectError('Cannot resolve %s::%s : %s' % (mib, symbol, e))
+        return '.'.join([ str(n) for n in oid.asTuple() ]), self._find_mib_file(mib)
+
+    def resolve(self, mib, symbol, *index):
+        """Get the numeric OID of a MIB symbol
+
+        Args:
+
+            mib (str): The MIB module name
+            symbol (str): The symbol name in the MIB module
+            index (int): The integers to append to the symbol OID (instance index)
+
+        Returns:
+
+            str: The numeric OID
+        """
+        if self.entries is None:
+            self._load()
+        key = '%s::%s' % (mib,symbol)
+        entry = self.entries.get(key)
+        if entry is None or not self._is_valid(entry):
+            naghelp.logger.debug('collect -> MIB cache miss for %s',key)
+            oid, path = self._resolve_with_mib(mib, symbol)
+            entry = self.entries[key] = {'oid':oid, 'path':path,
+                                         'mtime':os.path.getmtime(path) if path else None}
+            self._save()
+        # oids loaded from the json file are unicode
+        return '.'.join([ str(entry['oid']) ] + [ str(i) for i in index ])
+
+MIB_CACHE = MibCache()
+"""The :class:`MibCache` used by :class:`Snmp` and :class:`SnmpPoller`"""
+
+def _normalize_snmp_oid(oid, mib_cache=True):
+    # (MIB, symbol, integers...) tuples are resolved by the cache, other indexes need pysnmp
+    if isinstance(oid,tuple):
+        if mib_cache and len(oid) >= 2 and all(isinstance(i,(int,long)) for i in oid[2:]):
+            return MIB_CACHE.resolve(*oid)
+        from pysnmp.entity.rfc3413.oneliner import cmdgen
+        return cmdgen.MibVariable(*oid)
+    return oid
+
+_SNMP_ENGINES = threading.local()
+
+def get_snmp_engine(key=None):
+    """Get the SNMP engine shared in the current thread
+
+    pysnmp engines are not thread-safe and SNMPv3 users are registered in the engine by name :
+    there is one engine per thread and per ``key``. :class:`Snmp` uses the SNMPv3 credentials as key,
+    so that the engine configuration (including the passwords to keys hashing) is done once per process.
+    Shared engines are held by many objects : they must never be closed, requests that may have to be
+    cancelled are run on a private engine instead.
+
+    Args:
+
+        key (hashable): The engine key (Default : None)
+
+    Returns:
+
+        SnmpEngine: The pysnmp engine
+    """
+    engines = getattr(_SNMP_ENGINES,'engines',None)
+    if engines is None:
+        engines = _SNMP_ENGINES.engines = {}
+    engine = engines.get(key)
+    if engine is None:
+        from pysnmp.entity.engine import SnmpEngine
+        engine = engines[key] = SnmpEngine()
+    return engine
+
+SNMP_DISCOVERY_CACHE_FILE = '/tmp/naghelp/snmp_discovery_cache.json'
+"""The file where :class:`SnmpDiscoveryCache` stores the SNMPv3 agents engine IDs and times"""
+
+class SnmpDiscoveryCache(object):
+    r"""On-disk cache of SNMPv3 agents discovery
+
+    Before the first SNMPv3 request to an agent, pysnmp discovers the agent engine ID, then its
+    boots/time counters : this costs extra round trips in every plugin run. This cache stores,
+    per agent and user, the engine ID, boots and time learned by the engine, and gives them back
+    to the engine of the next runs. The agent time is extrapolated with the elapsed time.
+    If the agent rebooted in between, it answers with a report and pysnmp discovers it again.
+
+    The localized keys are not stored : they are derived from the passwords and would be as
+    sensitive. They are computed once per process thanks to the shared engines
+    (see :func:`get_snmp_engine`).
+
+    pysnmp has no public API for the discovered values : the cache reads private attributes of
+    the pysnmp 4.3 and 4.4 SNMPv3 models. With other versions, the cache is not used and pysnmp
+    does the usual discovery.
+
+    Args:
+
+        filename (str): The cache file (Default : :data:`SNMP_DISCOVERY_CACHE_FILE`)
+        ttl (int): Time in seconds an entry can be used (Default : 3600)
+    """
+    def __init__(self, filename=SNMP_DISCOVERY_CACHE_FILE, ttl=3600):
+        self.filename = filename
+        self.ttl = ttl
+
+    def _load(self):
+        try:
+            with open(self.filename) as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, key, entry):
+        entries = self._load()
+        entries[key] = entry
+        try:
+            filedir = os.path.dirname(self.filename)
+            if not os.path.exists(filedir):
+                os.makedirs(filedir)
+            tmp_filename = '%s.%s' % (self.filename,os.getpid())
+            with open(tmp_filename,'w') as fh:
+                json.dump(entries,fh)
+            os.rename(tmp_filename,self.filename)
+        except (IOError, OSError),e:
+            naghelp.logger.debug('collect -> cannot save SNMP discovery cache %s : %s',self.filename,e)
+
+    def _get_engine_caches(self, engine):
+        # pysnmp keeps discovered values in private attributes of the SNMPv3 models,
+        # returns None if this pysnmp version does not have them
+        mpmod = engine.messageProcessingSubsystems.get(3)
+        usm = engine.securityModels.get(3)
+        engine_id_cache = getattr(mpmod, '_SnmpV3MessageProcessingModel__engineIdCache', None)
+        timeline = getattr(usm, '_SnmpUSMSecurityModel__timeline', None)
+        if not isinstance(engine_id_cache, dict) or not isinstance(timeline, dict):
+            naghelp.logger.debug('collect -> SNMP discovery cache not supported by this pysnmp version')
+            return None
+        return engine_id_cache, timeline
+
+    def load(self, engine, key, address):
+        """Give the cached discovery of an agent to an engine
+
+        Args:
+
+            engine (SnmpEngine): The pysnmp engine
+            key (str): The agent key (usually host, port and user)
+            address (tuple): The agent (ip, port) transport address
+        """
+        entry = self._load().get(key)
+        if not entry or not 0 <= time.time() - entry['saved_at'] < self.ttl:
+            return
+        caches = self._get_engine_caches(engine)
+        if caches is None:
+            return
+        try:
+            from pyasn1.type import univ
+            engine_id_cache, timeline = caches
+            engine_id = univ.OctetString(hexValue=entry['engine_id'])
+            engine_id_cache[(tuple(entry['domain']), tuple(address))] = {
+                'securityEngineId':engine_id,
+                'contextEngineId':univ.OctetString(hexValue=entry['context_engine_id']),
+                'contextName':str(entry['context_name'])}
+            if engine_id not in timeline:
+                now = time.time()
+                engine_time = int(entry['time'] + now - entry['saved_at'])
+                timeline[engine_id] = (entry['boots'], engine_time, engine_time, int(now))
+            naghelp.logger.debug('collect -> SNMP discovery cache hit for %s',key)
+        except Exception,e:
+            naghelp.logger.debug('collect -> cannot load SNMP discovery cache for %s : %s',key,e)
+
+    def save(self, engine, key, address):
+        """Store the discovery of an agent done by an engine
+
+        Args:
+
+            engine (SnmpEngine): The pysnmp engine
+            key (str): The agent key (usually host, port and user)
+            address (tuple): The agent (ip, port) transport address
+        """
+        caches = self._get_engine_caches(engine)
+        if caches is None:
+            return
+        try:
+            engine_id_cache, timeline = caches
+            for (domain,cached_address),ids in engine_id_cache.items():
+                if tuple(cached_address) == tuple(address) and ids['securityEngineId'] in timeline:
+                    break
+            else:
+                return
+            boots, engine_time, latest_time, updated_at = timeline[ids['securityEngineId']]
+            # some pysnmp versions do not store the update timestamp
+            if not updated_at > 1e9:
+                updated_at = time.time()
+            entry = {'domain':list(domain),
+                     'engine_id':binascii.hexlify(str(ids['securityEngineId'])),
+                     'context_engine_id':binascii.hexlify(str(ids['contextEngineId'])),
+                     'context_name':str(ids['contextName']),
+                     'boots':int(boots),
+                     'time':int(engine_time),
+                     'saved_at':updated_at}
+        except Exception,e:
+            naghelp.logger.debug('collect -> cannot get SNMP discovery for %s : %s',key,e)
+            return
+        old_entry = self._load().get(key)
+        if old_entry is None or any(old_entry.get(k) != entry[k] for k in ('engine_id','boots','domain')) \
+                or time.time() - old_entry['saved_at'] > self.ttl / 2:
+            self._save(key, entry)
+
+SNMP_DISCOVERY_CACHE = SnmpDiscoveryCache()
+"""The :class:`SnmpDiscoveryCache` used by :class:`Snmp`"""
+
+def _get_snmp_auth_data(version, community='public', user=None, auth_passwd=None, auth_protocol='',
+                        priv_passwd=None, priv_protocol=''):
+    from pysnmp.entity.rfc3413.oneliner import cmdgen
+    if version == 1:
+        return cmdgen.CommunityData(community, mpModel=0)
+    elif version in  [2,'2c']:
+        return cmdgen.CommunityData(community)
+    elif version == 3:
+        authProtocol = None
+        privProtocol = None
+        if auth_passwd and auth_protocol.lower() == 'sha':
+             authProtocol = cmdgen.usmHMACSHAAuthProtocol
+        if priv_passwd and auth_protocol.lower() == 'aes':
+             privProtocol = cmdgen.usmAesCfb128Protocol
+        if not auth_passwd:
+            auth_passwd = None
+        if not priv_passwd:
+            priv_passwd = None
+        if not user:
+            raise ConnectionError('user must be not empty')
+        return cmdgen.UsmUserData(user, auth_passwd, priv_passwd,
+            authProtocol=authProtocol,
+            privProtocol=privProtocol )
+    raise ConnectionError('Bad snmp version protocol, given : %s, possible : 1,2,2c,3' % version)
+
+def _get_snmp_engine_key(version, user, auth_passwd, auth_protocol, priv_passwd, priv_protocol):
+    # protocol 3 users are registered by name in the engine : one engine per credentials
+    return ('v3', user, auth_passwd, auth_protocol, priv_passwd, priv_protocol) if version == 3 else None
+
+# pysnmp value class -> conversion function, filled on demand by _get_snmp_converter()
+_SNMP_CONVERTERS = {}
+
+def _snmp_to_str(oval):
+    return textops.StrExt(oval.prettyPrint())
+
+def _snmp_unchanged(oval):
+    return oval
+
+def _get_snmp_converter(cls):
+    from pysnmp.proto.api import v2c
+    # all integers and counters are pyasn1 integers : int() gets the value without formatting it
+    if issubclass(cls, (v2c.Integer, v2c.Integer32, v2c.Unsigned32, v2c.Counter32, v2c.Counter64,
+                        v2c.Gauge32, v2c.TimeTicks)):
+        convert = int
+    elif issubclass(cls, (v2c.OctetString, v2c.IpAddress)):
+        convert = _snmp_to_str
+    else:
+        convert = _snmp_unchanged
+    _SNMP_CONVERTERS[cls] = convert
+    return convert
+
+def _snmp_to_native_type(oval):
+    try:
+        return _SNMP_CONVERTERS[oval.__class__](oval)
+    except KeyError:
+        return _get_snmp_converter(oval.__class__)(oval)
+
+def _snmp_varbinds_to_native(varBinds):
+    """Convert (name, value) pysnmp varbinds into a list of (OID string, native value)"""
+    converters = _SNMP_CONVERTERS
+    lst = []
+    append = lst.append
+    for name, val in varBinds:
+        convert = converters.get(val.__class__) or _get_snmp_converter(val.__class__)
+        append((str(name), convert(val)))
+    return lst
+
+def _get_snmp_oid_range(oid_range):
+    oids = []
+    if oid_range.count('-') == 1:
+        begin,end = oid_range.split('-')
+        oid_begin = begin.split('.')[:-1]
+        id_begin = int(begin.split('.')[-1])
+        oid_end = end.split('.')[1:]
+        id_end = int(end.split('.')[0])
+        if id_begin > id_end:
+            return []
+        for id in xrange(id_begin,id_end + 1):
+            real_oid = '.'.join(oid_begin + [str(id)] + oid_end)
+            oids.append(real_oid)
+    else:
+        raise CollectError('An OID range must have one and only one "-"')
+    return oids
+
+def _oid_to_tuple(oid):
+    if isinstance(oid, tuple):
+        return oid
+    return tuple(int(n) for n in str(oid).strip('.').split('.'))
+
+class OidIndex(object):
+    r"""Index over a walk output to find OIDs and subtrees quickly
+
+    OIDs are stored as tuples of integers in a sorted list, so that exact lookups, subtree slicing
+    and next-OID queries are done by bisection in O(log n) instead of scanning the whole walk output.
+    One broad walk can then answer many queries. :meth:`Snmp.walk` and :meth:`Snmp.mwalk` return
+    an :class:`OidIndex` when ``index=True`` is given.
+
+    Args:
+
+        walk_data (list): List of tuples (OID,value) as returned by :meth:`Snmp.walk`
+
+    Examples:
+
+        >>> index = OidIndex([('1.3.6.1.2.1.1.1.0','Linux'),('1.3.6.1.2.1.1.3.0',1234),
+        ...                   ('1.3.6.1.2.1.2.2.1.2.1','lo'),('1.3.6.1.2.1.2.2.1.2.2','eth0'),
+        ...                   ('1.3.6.1.2.1.2.2.1.10.1',0)])
+        >>> index.get('1.3.6.1.2.1.1.3.0')
+        1234
+        >>> print index.subtree('1.3.6.1.2.1.2.2.1.2')
+        [('1.3.6.1.2.1.2.2.1.2.1', 'lo'), ('1.3.6.1.2.1.2.2.1.2.2', 'eth0')]
+        >>> index.next('1.3.6.1.2.1.1.1.0')
+        ('1.3.6.1.2.1.1.3.0', 1234)
+        >>> '1.3.6.1.2.1.2.2.1.10.1' in index
+        True
+    """
+    def __init__(self, walk_data=()):
+        items = [ (_oid_to_tuple(oid),str(oid),val) for oid,val in walk_data ]
+        items.sort(key=lambda item:item[0])
+        #: Sorted list of OIDs as tuples of integers
+        self.keys = [ item[0] for item in items ]
+        self.oids = [ item[1] for item in items ]
+        self.values = [ item[2] for item in items ]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(zip(self.oids,self.values))
+
+    def __contains__(self, oid):
+        key = _oid_to_tuple(oid)
+        i = bisect.bisect_left(self.keys,key)
+        return i < len(self.keys) and self.keys[i] == key
+
+    def get(self, oid, default=NoAttr):
+        """Get the value of an OID (:class:`NoAttr` if not found)"""
+        key = _oid_to_tuple(oid)
+        i = bisect.bisect_left(self.keys,key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.values[i]
+        return default
+
+    def _subtree_range(self, oid):
+        key = _oid_to_tuple(oid)
+        first = bisect.bisect_left(self.keys,key)
+        if not key:
+            return first, len(self.keys)
+        # all OIDs under key are lower than the next sibling of key
+        last = bisect.bisect_left(self.keys,key[:-1] + (key[-1] + 1,),first)
+        return first, last
+
+    def subtree(self, oid):
+        """Get the OIDs under a root path
+
+        Returns:
+
+            :class:`textops.ListExt`: List of tuples (OID,value) like :meth:`Snmp.walk`
+        """
+        first, last = self._subtree_range(oid)
+        return textops.ListExt(zip(self.oids[first:last],self.values[first:last]))
+
+    def subindex(self, oid):
+        """Get a new :class:`OidIndex` with the OIDs under a root path, without sorting again"""
+        first, last = self._subtree_range(oid)
+        index = OidIndex()
+        index.keys = self.keys[first:last]
+        index.oids = self.oids[first:last]
+        index.values = self.values[first:last]
+        return index
+
+    def next(self, oid):
+        """Get the first tuple (OID,value) after an OID like a GETNEXT request, None at the end"""
+        i = bisect.bisect_right(self.keys,_oid_to_tuple(oid))
+        if i < len(self.keys):
+            return self.oids[i],self.values[i]
+        return None
+
+class SnmpTable(object):
+    r"""Columnar SNMP table built from a walk output
+
+    The table is built in a single pass over the walk output : each OID gives a row id and a column id
+    (see ``irow`` and ``icol``), row ids are kept sorted in a list with their position in a dictionary,
+    each column is a list of values in the same order. Missing values are :class:`NoAttr`.
+    It is used by :meth:`Snmp.dwalk`, :meth:`Snmp.twalk` and :meth:`Snmp.jwalk`, and is returned by
+    :meth:`Snmp.cwalk`.
+
+    Args:
+
+        walk_data (list): List of tuples (OID,value) as returned by :meth:`Snmp.walk`
+        irow (int): The OID element index holding the row id (Default : -2)
+        icol (int): The OID element index holding the column id (Default : -1)
+
+    Examples:
+
+        >>> walk_data = [('1.3.6.1.2.1.2.2.1.2.1','lo'),('1.3.6.1.2.1.2.2.1.2.2','eth0'),
+        ...              ('1.3.6.1.2.1.2.2.1.5.2',1000)]
+        >>> table = SnmpTable(walk_data,irow=-1,icol=-2)
+        >>> table.row_ids
+        [1, 2]
+        >>> table.get(2,5)
+        1000
+        >>> table.row(1)
+        {2: 'lo'}
+        >>> print table.to_table([2,5])
+        [[1, 'lo', NoAttr], [2, 'eth0', 1000]]
+        >>> row = table.to_table({'name':2})[1]
+        >>> row._row, row.name
+        (2, 'eth0')
+    """
+    def __init__(self, walk_data=(), irow=-2, icol=-1):
+        row_ids = []
+        row_pos = {}
+        columns = {}
+        if irow < 0 and icol < 0:
+            # only the last OID elements are needed
+            maxsplit = max(-irow,-icol)
+            split = lambda oid: oid.rsplit('.',maxsplit)
+        else:
+            split = lambda oid: oid.split('.')
+        for oid,val in walk_data:
+            oid_bits = split(str(oid))
+            row = int(oid_bits[irow])
+            col = int(oid_bits[icol])
+            pos = row_pos.get(row)
+            if pos is None:
+                pos = row_pos[row] = len(row_ids)
+                row_ids.append(row)
+            column = columns.get(col)
+            if column is None:
+                column = columns[col] = []
+            if len(column) <= pos:
+                column.extend([NoAttr] * (pos - len(column)))
+                column.append(val)
+            elif column[pos] is NoAttr:
+                # like a walk, keep the first value
+                column[pos] = val
+        nb_rows = len(row_ids)
+        for column in columns.values():
+            column.extend([NoAttr] * (nb_rows - len(column)))
+        if any(row_ids[i] > row_ids[i+1] for i in xrange(nb_rows - 1)):
+            order = sorted(xrange(nb_rows),key=row_ids.__getitem__)
+            row_ids = [ row_ids[i] for i in order ]
+            row_pos = dict((row,pos) for pos,row in enumerate(row_ids))
+            for col,column in columns.items():
+                columns[col] = [ column[i] for i in order ]
+        #: Sorted list of row ids
+        self.row_ids = row_ids
+        #: Dictionary row id -> row position in columns
+        self.row_pos = row_pos
+        #: Dictionary column id -> list of values
+        self.columns = columns
+        #: Sorted list of column ids
+        self.col_ids = sorted(columns)
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    def __contains__(self, row_id):
+        return row_id in self.row_pos
+
+    def get(self, row_id, col, default=NoAttr):
+        """Get one value by row id and column id"""
+        pos = self.row_pos.get(row_id)
+        column = self.columns.get(col)
+        if pos is None or column is None or column[pos] is NoAttr:
+            return default
+        return column[pos]
+
+    def column(self, col):
+        """Get the values of a column in row ids order (:class:`NoAttr` for missing values)"""
+        return textops.ListExt(self.columns.get(col) or [NoAttr] * len(self.row_ids))
+
+    def _row_values(self, pos, cols=None):
+        if cols is None:
+            return [ val for val in (self.columns[c][pos] for c in self.col_ids) if val is not NoAttr ]
+        columns = self.columns
+        return [ columns[c][pos] if c in columns else NoAttr for c in cols ]
+
+    def _row_dict(self, row_id, pos, cols):
+        columns = self.columns
+        return dict([ (k,columns[v][pos] if v in columns else NoAttr) for k,v in cols.items() ],_row=row_id)
+
+    def row(self, row_id):
+        """Get a row as a dictionary column id -> value, with only the existing values"""
+        pos = self.row_pos.get(row_id)
+        if pos is None:
+            return {}
+        return dict((c,self.columns[c][pos]) for c in self.col_ids if self.columns[c][pos] is not NoAttr)
+
+    def to_dict(self):
+        """Convert to the :meth:`Snmp.dwalk` format : a dictionary of row dictionaries"""
+        return textops.DictExt((row_id,self.row(row_id)) for row_id in self.row_ids)
+
+    def to_table(self, cols=None):
+        """Convert to the :meth:`Snmp.twalk` format
+
+        Args:
+
+            cols (None, list or dict): If None, each row is a list with the row id followed by
+                the existing values in column ids order. If a list, each row is a list with the row id
+                followed by the values of the given column ids. If a dict (key -> column id), each row
+                is a dictionary with the row id under ``_row``.
+
+        Returns:
+
+            :class:`textops.ListExt`: The table rows sorted by row id
+        """
+        table = textops.ListExt()
+        if isinstance(cols,dict):
+            for pos,row_id in enumerate(self.row_ids):
+                table.append(self._row_dict(row_id,pos,cols))
+        elif cols is None or isinstance(cols,(list,tuple)):
+            for pos,row_id in enumerate(self.row_ids):
+                table.append([ row_id ] + self._row_values(pos,cols))
+        return table
+
+    @staticmethod
+    def join(tables_cols):
+        """Join many tables on their row id
+
+        Args:
+
+            tables_cols (list): List of tuples (:class:`SnmpTable`, cols), cols being like in
+                :meth:`to_table`. All cols must be lists/tuples/None or all must be dicts.
+
+        Returns:
+
+            :class:`textops.ListExt`: If cols are dicts, the rows are the dictionaries of all tables
+            merged together, otherwise the rows are the row id followed by the values of all tables
+            having this row. Rows are sorted by row id.
+        """
+        row_ids = sorted(set().union(*[ table.row_pos for table,cols in tables_cols ]))
+        joined = textops.ListExt()
+        as_dicts = bool(tables_cols) and isinstance(tables_cols[0][1],dict)
+        for row_id in row_ids:
+            row = {} if as_dicts else [ row_id ]
+            for table,cols in tables_cols:
+                pos = table.row_pos.get(row_id)
+                if pos is not None:
+                    if as_dicts:
+                        row.update(table._row_dict(row_id,pos,cols))
+                    else:
+                        row += table._row_values(pos,cols)
+            joined.append(row)
+        return joined
+
 class Snmp(object):
     r"""Snmp class helper
 
@@ -1298,77 +3347,88 @@ class Snmp(object):
         auth_protocol (str): snmp v3 auth protocol ('md5' or 'sha')
         priv_passwd (str): snmp v3 privacy password
         priv_protocol (str): snmp v3 privacy protocol ('des' or 'aes')
+        bulk (bool): Use GETBULK requests for walks : many rows are returned per request.
+            If None (Default), GETBULK is used with protocols 2c and 3, GETNEXT with protocol 1.
+        max_repetitions (int): The number of rows asked per GETBULK request (Default : 25)
+        max_varbinds (int): The maximum number of OIDs per request for :meth:`mget` (Default : 50)
+        mib_cache (bool): Resolve ``(MIB, symbol, index)`` OIDs with :data:`MIB_CACHE` when the
+            index is made of integers (Default : True)
+        discovery_cache (bool): With protocol 3, keep the agent engine ID and time in
+            :data:`SNMP_DISCOVERY_CACHE` to skip the discovery in the next runs (Default : True)
+
+    The SNMP engine used by :meth:`get`, :meth:`walk` and :meth:`exists` is shared with the other
+    :class:`Snmp` objects of the same thread having the same credentials (see :func:`get_snmp_engine`).
+    :meth:`mget` and concurrent :meth:`mwalk` run on an engine owned by this object : it is closed
+    when they time out, without disturbing the other :class:`Snmp` objects.
     """
     def __init__(self,host, community='public', version=None, timeout=30, port=161, user=None,
-                 auth_passwd=None, auth_protocol='', priv_passwd=None, priv_protocol='', *args,**kwargs):
+                 auth_passwd=None, auth_protocol='', priv_passwd=None, priv_protocol='',
+                 bulk=None, max_repetitions=25, max_varbinds=50, mib_cache=True, discovery_cache=True, *args,**kwargs):
         #import is done only on demand, because it takes some little time
         from pysnmp.entity.rfc3413.oneliner import cmdgen
         from pysnmp.proto.api import v2c
         from pysnmp.smi.exval import noSuchInstance
+        from pysnmp.proto.rfc1905 import EndOfMibView, NoSuchInstance, NoSuchObject
         self.cmdgen = cmdgen
         self.v2c = v2c
         self.noSuchInstance = noSuchInstance
-        self.cmdGenerator = cmdgen.CommandGenerator()
+        self.EndOfMibView = EndOfMibView
+        self.NoSuchInstance = NoSuchInstance
+        self.NoSuchObject = NoSuchObject
         self.version = version
         self.cmd_args = []
 
         if not version:
             version = user and 3 or 2
-
-        if version == 1:
-            self.cmd_args.append(cmdgen.CommunityData(community, mpModel=0))
-        elif version in  [2,'2c']:
-            self.cmd_args.append(cmdgen.CommunityData(community))
-        elif version == 3:
-            authProtocol = None
-            privProtocol = None
-            if auth_passwd and auth_protocol.lower() == 'sha':
-                 authProtocol = cmdgen.usmHMACSHAAuthProtocol
-            if priv_passwd and auth_protocol.lower() == 'aes':
-                 privProtocol = cmdgen.usmAesCfb128Protocol
-            if not auth_passwd:
-                auth_passwd = None
-            if not priv_passwd:
-                priv_passwd = None
-            if not user:
-                raise ConnectionError('user must be not empty')
-            self.cmd_args.append(cmdgen.UsmUserData(user, auth_passwd, priv_passwd,
-                authProtocol=authProtocol,
-                privProtocol=privProtocol ) )
-        else:
-            raise ConnectionError('Bad snmp version protocol, given : %s, possible : 1,2,2c,3' % version)
-
-        self.cmd_args.append(cmdgen.UdpTransportTarget((host, port),timeout = timeout/3, retries=2))
+        # GETBULK does not exist in protocol 1
+        self.bulk = version != 1 if bulk is None else bulk
+        self.max_repetitions = max_repetitions
+        self.max_varbinds = max_varbinds
+        self.mib_cache = mib_cache
+
+        self.cmd_args.append(_get_snmp_auth_data(version, community, user, auth_passwd, auth_protocol,
+                                                 priv_passwd, priv_protocol))
+        self.timeout = timeout
+        transport_target = cmdgen.UdpTransportTarget((host, port),timeout = timeout/3, retries=2)
+        self.cmd_args.append(transport_target)
+        self.engine_key = _get_snmp_engine_key(version, user, auth_passwd, auth_protocol,
+                                               priv_passwd, priv_protocol)
+        self.cmdGenerator = cmdgen.CommandGenerator(snmpEngine=get_snmp_engine(self.engine_key))
+        self.async_engine = None
+        self.agent_key = '%s:%s' % (host, port)
+        self.discovery_key = None
+        if version == 3 and discovery_cache:
+            self.discovery_key = '%s:%s:%s' % (host, port, user)
+            self.discovery_address = getattr(transport_target, 'transportAddr', None) or \
+                                     (socket.gethostbyname(host), port)
+            self._load_discovery(self.cmdGenerator.snmpEngine)
+
+    def _load_discovery(self, engine):
+        if self.discovery_key is not None:
+            SNMP_DISCOVERY_CACHE.load(engine, self.discovery_key, self.discovery_address)
+
+    def _save_discovery(self, engine):
+        if self.discovery_key is not None:
+            SNMP_DISCOVERY_CACHE.save(engine, self.discovery_key, self.discovery_address)
+
+    def _get_async_engine(self):
+        # requests that can be cancelled run on an engine owned by this object :
+        # on timeout it is closed, the shared engine of the other Snmp objects is left untouched
+        if self.async_engine is None:
+            from pysnmp.entity.engine import SnmpEngine
+            self.async_engine = SnmpEngine()
+            self._load_discovery(self.async_engine)
+        return self.async_engine
 
     def to_native_type(self,oval):
-        v2c = self.v2c
-        if isinstance(oval, v2c.Integer):
-            val = int(oval.prettyPrint())
-        elif isinstance(oval, v2c.Integer32):
-            val = int(oval.prettyPrint())
-        elif isinstance(oval, v2c.Unsigned32):
-            val = int(oval.prettyPrint())
-        elif isinstance(oval, v2c.Counter32):
-            val = int(oval.prettyPrint())
-        elif isinstance(oval, v2c.Counter64):
-            val = int(oval.prettyPrint())
-        elif isinstance(oval, v2c.Gauge32):
-            val = int(oval.prettyPrint())
-        elif isinstance(oval, v2c.TimeTicks):
-            val = int(oval.prettyPrint())
-        elif isinstance(oval, v2c.OctetString):
-            val = textops.StrExt(oval.prettyPrint())
-        elif isinstance(oval, v2c.IpAddress):
-            val = textops.StrExt(oval.prettyPrint())
-        else:
-            val = oval
-        return val
+        return _snmp_to_native_type(oval)
 
     def normalize_oid(self,oid):
         """Normalize OID object in order to be used with pysnmp methods
 
-        Basically, it converts OID with a tuple form into a ObjectIdentity form,
-        keeping other forms unchanged.
+        Basically, it converts OID with a tuple form into a numeric OID with :data:`MIB_CACHE`
+        or into a ObjectIdentity form if the index is not made of integers or ``mib_cache``
+        is False, keeping other forms unchanged.
 
         Args:
 
@@ -1380,16 +3440,17 @@ class Snmp(object):
 
         Examples:
 
-            >>> s=Snmp('demo.snmplabs.com')
-            >>> s.normalize_oid(('SNMPv2-MIB', 'sysDescr2', 0))
-            ObjectIdentity('SNMPv2-MIB', 'sysDescr2', 0)
+            >>> s=Snmp('localhost')
+            >>> s.normalize_oid(('SNMPv2-MIB', 'sysDescr', 0))
+            '1.3.6.1.2.1.1.1.0'
+            >>> s=Snmp('localhost',mib_cache=False)
+            >>> s.normalize_oid(('SNMPv2-MIB', 'sysDescr', 0))
+            ObjectIdentity('SNMPv2-MIB', 'sysDescr', 0)
             >>> s.normalize_oid('1.3.6.1.2.1.1.1.0')
             '1.3.6.1.2.1.1.1.0'
 
         """
-        if isinstance(oid,tuple):
-            return self.cmdgen.MibVariable(*oid)
-        return oid
+        return _normalize_snmp_oid(oid, self.mib_cache)
 
     def get(self,oid_or_mibvar):
         """get one OID
@@ -1406,20 +3467,20 @@ class Snmp(object):
 
             To collect a numerical OID::
 
-                >>> snmp = Snmp('demo.snmplabs.com')
-                >>> snmp.get('1.3.6.1.2.1.1.1.0')
+                >>> snmp = Snmp('demo.snmplabs.com')  #doctest: +SKIP
+                >>> snmp.get('1.3.6.1.2.1.1.1.0')  #doctest: +SKIP
                 'SunOS zeus.snmplabs.com 4.1.3_U1 1 sun4m'
 
             To collect an OID with label form::
 
-                >>> snmp = Snmp('demo.snmplabs.com')
-                >>> snmp.get('iso.org.dod.internet.mgmt.mib-2.system.sysDescr.0')
+                >>> snmp = Snmp('demo.snmplabs.com')  #doctest: +SKIP
+                >>> snmp.get('iso.org.dod.internet.mgmt.mib-2.system.sysDescr.0')  #doctest: +SKIP
                 'SunOS zeus.snmplabs.com 4.1.3_U1 1 sun4m'
 
             To collect an OID with MIB symbol form::
 
-                >>> snmp = Snmp('demo.snmplabs.com')
-                >>> snmp.get(('SNMPv2-MIB', 'sysDescr', 0))
+                >>> snmp = Snmp('demo.snmplabs.com')  #doctest: +SKIP
+                >>> snmp.get(('SNMPv2-MIB', 'sysDescr', 0))  #doctest: +SKIP
                 'SunOS zeus.snmplabs.com 4.1.3_U1 1 sun4m'
         """
         naghelp.logger.debug('collect -> get(%s) %s',oid_or_mibvar,naghelp.debug_caller())
@@ -1430,6 +3491,7 @@ class Snmp(object):
         if errorIndication:
             raise CollectError(errorIndication)
         else:
+            self._save_discovery(self.cmdGenerator.snmpEngine)
             if errorStatus:
                 try:
                     err_at = errorIndex and varBinds[int(errorIndex)-1] or '?'
@@ -1438,22 +3500,27 @@ class Snmp(object):
                 raise CollectError('%s at %s' % (errorStatus.prettyPrint(),err_at) )
         return self.to_native_type(varBinds[0][1])
 
-    def walk(self,oid_or_mibvar):
+    def walk(self,oid_or_mibvar,index=False):
         """Walk from a OID root path
 
+        With protocols 2c and 3, GETBULK requests are used : ``max_repetitions`` rows are returned
+        per request instead of one (see ``bulk`` and ``max_repetitions`` :class:`Snmp` parameters).
+
         Args:
 
             oid_or_mibvar (str or ObjectIdentity): an OID path or a pysnmp ObjectIdentity
+            index (bool): Return an :class:`OidIndex` instead of a list (Default : False)
 
         Returns:
 
             :class:`textops.ListExt`: List of tuples (OID,value).
-                Values type are int or :class:`textops.StrExt`
+                Values type are int or :class:`textops.StrExt`. An :class:`OidIndex` if ``index``
+                is True.
 
         Example:
 
-            >>> snmp = Snmp('localhost')
-            >>> for oid,val in snmp.walk('1.3.6.1.2.1.1'):  #doctest: +ELLIPSIS, +NORMALIZE_WHITESPACE
+            >>> snmp = Snmp('localhost')  #doctest: +SKIP
+            >>> for oid,val in snmp.walk('1.3.6.1.2.1.1'):  #doctest: +ELLIPSIS, +NORMALIZE_WHITESPACE, +SKIP
             ...     print oid,'-->',val
             ...
             1.3.6.1.2.1.1.1.0 --> SunOS zeus.snmplabs.com 4.1.3_U1 1 sun4m
@@ -1465,38 +3532,133 @@ class Snmp(object):
         oid_or_mibvar = self.normalize_oid(oid_or_mibvar)
         lst = textops.ListExt()
         args = list(self.cmd_args)
-        args.append(oid_or_mibvar)
-        errorIndication, errorStatus, errorIndex, varBindTable = self.cmdGenerator.nextCmd(*args)
+        if self.bulk:
+            # non-repeaters = 0 : all requested OIDs are walked
+            args += [ 0, self.max_repetitions ]
+            args.append(oid_or_mibvar)
+            errorIndication, errorStatus, errorIndex, varBindTable = self.cmdGenerator.bulkCmd(*args)
+        else:
+            args.append(oid_or_mibvar)
+            errorIndication, errorStatus, errorIndex, varBindTable = self.cmdGenerator.nextCmd(*args)
         if errorIndication:
             raise CollectError(errorIndication)
         else:
+            self._save_discovery(self.cmdGenerator.snmpEngine)
             if errorStatus:
                 try:
                     err_at = errorIndex and varBindTable[-1][int(errorIndex)-1] or '?'
                 except:
                     err_at = '?'
                 raise CollectError('%s at %s' % (errorStatus.prettyPrint(),err_at) )
-        for varBindTableRow in varBindTable:
-            for name, val in varBindTableRow:
-                lst.append((str(name),self.to_native_type(val)))
-        return lst
-
-    def mwalk(self,vars_oids):
+        # pysnmp may pad the last GETBULK response with end-of-walk markers
+        lst.extend(_snmp_varbinds_to_native([ (name, val) for varBindTableRow in varBindTable
+                                              for name, val in varBindTableRow
+                                              if not isinstance(val, self.EndOfMibView) ]))
+        return OidIndex(lst) if index else lst
+
+    def _run_dispatcher(self, engine, timeout, what, state):
+        # run the requests sent asynchronously on the engine with an overall deadline
+        timeout = limit_timeout(self.timeout if timeout is None else timeout)
+        deadline = monotonic() + timeout
+        def check_deadline(timeNow):
+            if monotonic() > deadline:
+                raise TimeoutError('Timeout (%ss) while %s' % (timeout, what))
+        dispatcher = engine.transportDispatcher
+        dispatcher.registerTimerCbFun(check_deadline)
+        try:
+            dispatcher.runDispatcher()
+        except TimeoutError:
+            state['cancelled'] = True
+            raise
+        finally:
+            dispatcher.unregisterTimerCbFun(check_deadline)
+            if state['cancelled']:
+                # requests still in flight would be waited by the next dispatcher run :
+                # close the engine, it is only used by this object
+                dispatcher.closeDispatcher()
+                if engine is self.async_engine:
+                    self.async_engine = None
+        self._save_discovery(engine)
+
+    def _walk_many(self, oids, timeout=None):
+        """Walk many OID root paths at the same time
+
+        All walks are sent on the same SNMP engine and run by a single dispatcher loop, so that
+        they cost about the latency of the longest one. Returns a list of :class:`textops.ListExt`
+        in the same order as ``oids``.
+        """
+        from pysnmp.hlapi.asyncore.cmdgen import nextCmd, bulkCmd
+        from pysnmp.hlapi.context import ContextData
+        from pysnmp.hlapi.varbinds import CommandGeneratorVarBinds
+        from pysnmp.proto.rfc1902 import Null
+        snmpEngine = self._get_async_engine()
+        authData, transportTarget = self.cmd_args[:2]
+        roots = [ vb[0] for vb in CommandGeneratorVarBinds().makeVarBinds(snmpEngine,
+                    [ (self.normalize_oid(oid), Null('')) for oid in oids ]) ]
+        results = [ textops.ListExt() for oid in oids ]
+        errors = [ None ] * len(oids)
+        state = {'cancelled':False}
+
+        def cbFun(snmpEngine, sendRequestHandle, errorIndication, errorStatus, errorIndex, varBindTable, i):
+            if state['cancelled']:
+                return False
+            if errorIndication:
+                errors[i] = CollectError(errorIndication)
+                return False
+            if errorStatus:
+                # protocol 1 agents answer noSuchName at the end of the MIB
+                if errorStatus != 2:
+                    try:
+                        err_at = errorIndex and varBindTable[-1][int(errorIndex)-1] or '?'
+                    except:
+                        err_at = '?'
+                    errors[i] = CollectError('%s at %s' % (errorStatus.prettyPrint(),err_at) )
+                return False
+            varBinds = []
+            for varBindTableRow in varBindTable:
+                for name, val in varBindTableRow:
+                    if isinstance(val, self.EndOfMibView) or not roots[i].isPrefixOf(name):
+                        results[i].extend(_snmp_varbinds_to_native(varBinds))
+                        return False
+                    varBinds.append((name, val))
+            results[i].extend(_snmp_varbinds_to_native(varBinds))
+            return True
+
+        for i,root in enumerate(roots):
+            if self.bulk:
+                bulkCmd(snmpEngine, authData, transportTarget, ContextData(), 0, self.max_repetitions,
+                        (root, Null('')), cbFun=cbFun, cbCtx=i, lookupMib=False)
+            else:
+                nextCmd(snmpEngine, authData, transportTarget, ContextData(),
+                        (root, Null('')), cbFun=cbFun, cbCtx=i, lookupMib=False)
+        self._run_dispatcher(snmpEngine, timeout, 'walking %s' % (oids,), state)
+        for error in errors:
+            if error is not None:
+                raise error
+        return results
+
+    def mwalk(self,vars_oids,concurrent=True,timeout=None,index=False):
         """Walk from multiple OID root pathes
 
         Args:
 
             vars_oids (dict): keyname/OID root path dictionary
+            concurrent (bool): Run all walks at the same time (Default : True). If False, walks are
+                done one after another.
+            timeout (int): The maximum time in seconds for all concurrent walks
+                (Default : the ``timeout`` given to :class:`Snmp`)
+            index (bool): Return :class:`OidIndex` objects instead of lists (Default : False)
 
         Returns:
 
             :class:`textops.DictExt`: A dictionary of list of tuples (OID,value).
-                Values type are int or :class:`textops.StrExt`
+                Values type are int or :class:`textops.StrExt`. A dictionary of :class:`OidIndex`
+                if ``index`` is True.
 
         Example:
 
-            >>> snmp = Snmp('localhost')
-            >>> print snmp.mwalk({'node1' : '1.3.6.1.2.1.1.9.1.2', 'node2' : '1.3.6.1.2.1.1.9.1.3'})
+            >>> snmp = Snmp('localhost')  #doctest: +SKIP
+            >>> print snmp.mwalk({'node1' : '1.3.6.1.2.1.1.9.1.2', 'node2' : '1.3.6.1.2.1.1.9.1.3'})  #doctest: +SKIP
             {'node1': [('1.3.6.1.2.1.1.9.1.2.1', ObjectIdentity(ObjectIdentifier('1.3.6.1.6.3.10.3.1.1'))),
                        ('1.3.6.1.2.1.1.9.1.2.2', ObjectIdentity(ObjectIdentifier('1.3.6.1.6.3.11.3.1.1')))
                        ... ],
@@ -1506,79 +3668,64 @@ class Snmp(object):
 
         """
         dct = textops.DictExt()
+        if concurrent:
+            naghelp.logger.debug('collect -> mwalk(...) %s',naghelp.debug_caller())
+            items = vars_oids.items()
+            walks = self._walk_many([ oid for var,oid in items ], timeout)
+            for (var,oid),walk_data in zip(items,walks):
+                dct[var] = OidIndex(walk_data) if index else walk_data
+            return dct
         for var,oid in vars_oids.items():
-            dct[var] = self.walk(oid)
+            dct[var] = self.walk(oid,index)
         return dct
 
+    def cwalk(self,oid_or_mibvar,irow=-2,icol=-1):
+        """Walk a table into a columnar :class:`SnmpTable`
+
+        Args:
+
+            oid_or_mibvar (str or ObjectIdentity): an OID path or a pysnmp ObjectIdentity
+            irow (int): The OID element index holding the row id (Default : -2)
+            icol (int): The OID element index holding the column id (Default : -1)
+
+        Returns:
+
+            :class:`SnmpTable`: The walked table
+        """
+        return SnmpTable(self.walk(oid_or_mibvar),irow,icol)
+
     def dwalk(self,oid_or_mibvar,irow=-2,icol=-1,cols=None):
-        walk_data = self.walk(oid_or_mibvar)
-        dct={}
-        for oid,val in walk_data:
-            oid_bits = str(oid).split('.')
-            row=int(oid_bits[irow])
-            col=int(oid_bits[icol])
-            dct.setdefault(row,{}).setdefault(col,val)
-        return textops.DictExt(dct)
+        return self.cwalk(oid_or_mibvar,irow,icol).to_dict()
 
     def twalk(self,oid_or_mibvar,irow=-2,icol=-1,cols=None):
-        walk_data = self.walk(oid_or_mibvar)
-        dct={}
-        table=textops.ListExt()
-        for oid,val in walk_data:
-            oid_bits = str(oid).split('.')
-            row=int(oid_bits[irow])
-            col=int(oid_bits[icol])
-            dct.setdefault(row,{}).setdefault(col,val)
-        if cols is None:
-            for row_id,rec_dct in sorted(dct.items()):
-                table.append( [ row_id ] + [ rec_dct.get(c,NoAttr) for c in sorted(rec_dct) ] )
-        elif isinstance(cols,(list,tuple)):
-            for row_id,rec_dct in sorted(dct.items()):
-                table.append( [ row_id ] + [ rec_dct.get(c,NoAttr) for c in cols ] )
-        elif isinstance(cols,dict):
-            for row_id,rec_dct in sorted(dct.items()):
-                table.append( dict([ (k,rec_dct.get(v,NoAttr)) for k,v in cols.items() ],_row=row_id) )
-        return table
+        return self.cwalk(oid_or_mibvar,irow,icol).to_table(cols)
 
-    def jwalk(self,*twalks_args):
-        dct={}
-        tables = textops.ListExt([ self.twalk(*twalk_args) for twalk_args in twalks_args ])
+    def jwalk(self,*twalks_args,**kwargs):
+        """Walk many tables and join them on their row index
+
+        All tables are walked at the same time unless ``concurrent=False`` is given as keyword
+        argument. A ``timeout`` keyword argument sets the maximum time for all walks.
+        Each table is kept in columns (see :class:`SnmpTable`) and rows are joined without
+        building intermediate tables.
+        """
         if isinstance(twalks_args[0][-1],(list,tuple,type(None))):
             for args in twalks_args:
                 assert isinstance(args[-1],(list,tuple,type(None))), 'All wanted columns specifications must be lists/tuples/None'
-            for table in tables:
-                for row in table:
-                    row_id = row[0]
-                    l=dct.setdefault(row_id,[row_id])
-                    l+=row[1:]
-            return textops.ListExt(sorted(dct.values(),key=lambda v:v[0]))
         else:
             for args in twalks_args:
                 assert isinstance(args[-1],dict), 'All wanted columns specifications must be dicts'
-            for table in tables:
-                for row in table:
-                    row_id = row['_row']
-                    dct.setdefault(row_id,{}).update(row)
-            return textops.ListExt(sorted(dct.values(),key=lambda v:v['_row']))
+        if kwargs.get('concurrent',True):
+            walks = self._walk_many([ args[0] for args in twalks_args ], kwargs.get('timeout'))
+            tables = [ SnmpTable(walk_data,*args[1:3]) for walk_data,args in zip(walks,twalks_args) ]
+        else:
+            tables = [ self.cwalk(*args[:3]) for args in twalks_args ]
+        return SnmpTable.join([ (table,args[3] if len(args) > 3 else None)
+                                for table,args in zip(tables,twalks_args) ])
 
     def get_oid_range(self,oid_range):
-        oids = []
-        if oid_range.count('-') == 1:
-            begin,end = oid_range.split('-')
-            oid_begin = begin.split('.')[:-1]
-            id_begin = int(begin.split('.')[-1])
-            oid_end = end.split('.')[1:]
-            id_end = int(end.split('.')[0])
-            if id_begin > id_end:
-                return []
-            for id in xrange(id_begin,id_end + 1):
-                real_oid = '.'.join(oid_begin + [str(id)] + oid_end)
-                oids.append(real_oid)
-        else:
-            raise CollectError('An OID range must have one and only one "-"')
-        return oids
+        return _get_snmp_oid_range(oid_range)
 
-    def mget(self,vars_oids):
+    def mget(self,vars_oids,data=None,max_varbinds=None,timeout=None):
         """Get multiple OIDs at the same time
 
         This method is much more faster than doing multiple :meth:`get` because it uses the same
@@ -1587,9 +3734,23 @@ class Snmp(object):
         For instance, '1.3.6.1.2.1.1.2-4.1' means : [ 1.3.6.1.2.1.1.2.1,
         1.3.6.1.2.1.1.3.1, 1.3.6.1.2.1.1.4.1 ]
 
+        OIDs are sent by chunks of ``max_varbinds`` OIDs, all chunks are sent at the same time.
+        When the agent answers ``tooBig``, the chunk is split in two and sent again : the chunk
+        size that works is stored per agent in ``data`` to be used directly by the next calls.
+        When full chunks of the learned size are received without error, the next call tries
+        a chunk size twice bigger, up to ``max_varbinds``.
+        OIDs that do not exist on the agent get a ``NoAttr`` value.
+
         Args:
 
             vars_oids (dict): keyname/OID dictionary
+            data (dict): Where to store the learned chunk sizes between calls, usually the
+                :class:`~naghelp.Host` object (key : ``snmp_max_varbinds``, a dictionary
+                with ``host:port`` keys). (Default : None)
+            max_varbinds (int): Maximum number of OIDs per request (Default : the learned size
+                in ``data`` if any, otherwise the ``max_varbinds`` given to :class:`Snmp`)
+            timeout (int): The maximum time in seconds for all requests
+                (Default : the ``timeout`` given to :class:`Snmp`)
 
         Returns:
 
@@ -1598,38 +3759,87 @@ class Snmp(object):
 
         Example:
 
-            >>> snmp = Snmp('demo.snmplabs.com')
-            >>> print snmp.mget({'uname':'1.3.6.1.2.1.1.0','other':'1.3.6.1.2.1.1.2-9.0'})  #doctest: +ELLIPSIS, +NORMALIZE_WHITESPACE
+            >>> snmp = Snmp('demo.snmplabs.com')  #doctest: +SKIP
+            >>> print snmp.mget({'uname':'1.3.6.1.2.1.1.0','other':'1.3.6.1.2.1.1.2-9.0'})  #doctest: +ELLIPSIS, +NORMALIZE_WHITESPACE, +SKIP
             {'uname' : 'SunOS zeus.snmplabs.com 4.1.3_U1 1 sun4m',
              'other' : ['value for 1.3.6.1.2.1.1.2.0', 'value for 1.3.6.1.2.1.1.3.0', etc... ] }
 
         """
         naghelp.logger.debug('collect -> mget(...) %s',naghelp.debug_caller())
-        dct = textops.DictExt()
+        from pysnmp.hlapi.asyncore.cmdgen import getCmd
+        from pysnmp.hlapi.context import ContextData
+        from pysnmp.proto.rfc1902 import Null
+        oids = []
         oid_to_var = {}
-        args = list(self.cmd_args)
         for var,oid in vars_oids.items():
-            if '-' in oid:
-                for real_oid in self.get_oid_range(oid):
-                    args.append(real_oid)
-                    oid_to_var[real_oid] = var
-            else:
-                args.append(oid)
-                oid_to_var[oid] = var
-
-        errorIndication, errorStatus, errorIndex, varBinds = self.cmdGenerator.getCmd(*args)
-        if errorIndication:
-            raise CollectError(errorIndication)
-        else:
-            if errorStatus:
+            for real_oid in (self.get_oid_range(oid) if '-' in oid else [ oid ]):
+                oids.append(real_oid)
+                oid_to_var[real_oid] = var
+        learned_sizes = data.get('snmp_max_varbinds') if data is not None else None
+        if not isinstance(learned_sizes, dict):
+            learned_sizes = {}
+        learned = learned_sizes.get(self.agent_key)
+        chunk_size = max(max_varbinds or learned or self.max_varbinds, 1)
+        snmpEngine = self._get_async_engine()
+        authData, transportTarget = self.cmd_args[:2]
+        values = [ None ] * len(oids)
+        errors = []
+        state = {'cancelled':False, 'chunk_size':chunk_size}
+
+        def send(first, last):
+            getCmd(snmpEngine, authData, transportTarget, ContextData(),
+                   *[ (oid, Null('')) for oid in oids[first:last] ],
+                   **dict(cbFun=cbFun, cbCtx=(first, last), lookupMib=False))
+
+        def cbFun(snmpEngine, sendRequestHandle, errorIndication, errorStatus, errorIndex, varBinds, cbCtx):
+            first, last = cbCtx
+            if state['cancelled'] or errors:
+                return
+            if errorIndication:
+                errors.append(CollectError(errorIndication))
+            elif errorStatus == 1 and last - first > 1:
+                # tooBig : send the chunk again in two halves
+                middle = (first + last) // 2
+                state['chunk_size'] = min(state['chunk_size'], middle - first)
+                naghelp.logger.debug('collect -> mget : tooBig for %s OIDs, retry with %s', last - first, middle - first)
+                send(first, middle)
+                send(middle, last)
+            elif errorStatus:
                 try:
                     err_at = errorIndex and varBinds[int(errorIndex)-1] or '?'
                 except:
                     err_at = '?'
-                raise CollectError('%s at %s' % (errorStatus.prettyPrint(),err_at) )
-        for oid,val in varBinds:
-            var = oid_to_var[str(oid)]
-            val = self.to_native_type(val) if not (val is self.noSuchInstance) else NoAttr
+                errors.append(CollectError('%s at %s' % (errorStatus.prettyPrint(),err_at) ))
+            elif len(varBinds) != last - first:
+                # values are matched to OIDs by position : a short response would shift them
+                errors.append(CollectError('%s values received for %s requested OIDs' % (len(varBinds), last - first)))
+            else:
+                values[first:last] = [ val for oid,val in varBinds ]
+
+        for first in range(0, len(oids), chunk_size):
+            send(first, min(first + chunk_size, len(oids)))
+        if oids:
+            self._run_dispatcher(snmpEngine, timeout, 'getting %s OIDs' % len(oids), state)
+        if errors:
+            raise errors[0]
+        if data is not None:
+            size = learned
+            if state['chunk_size'] < chunk_size:
+                size = state['chunk_size']
+            elif learned and not max_varbinds and len(oids) >= chunk_size:
+                # the agent may accept more now (other OIDs, agent upgrade...) : let the size grow back
+                size = chunk_size * 2
+            if size != learned:
+                if size >= self.max_varbinds:
+                    learned_sizes.pop(self.agent_key, None)
+                else:
+                    learned_sizes[self.agent_key] = size
+                data['snmp_max_varbinds'] = learned_sizes
+
+        dct = textops.DictExt()
+        for oid,val in zip(oids,values):
+            var = oid_to_var[oid]
+            val = NoAttr if isinstance(val, (self.NoSuchInstance, self.NoSuchObject)) else self.to_native_type(val)
             if var in dct:
                 if isinstance(dct[var],list):
                     dct[var].append(val)
@@ -1656,10 +3866,10 @@ class Snmp(object):
 
             To collect a numerical OID::
 
-                >>> snmp = Snmp('demo.snmplabs.com')
-                >>> snmp.exists('1.3.6.1.2.1.1.1.0')
+                >>> snmp = Snmp('demo.snmplabs.com')  #doctest: +SKIP
+                >>> snmp.exists('1.3.6.1.2.1.1.1.0')  #doctest: +SKIP
                 True
-                >>> snmp.exists('1.3.6.1.2.1.1.1.999')
+                >>> snmp.exists('1.3.6.1.2.1.1.1.999')  #doctest: +SKIP
                 False
         """
         oid_or_mibvar = self.normalize_oid(oid_or_mibvar)
@@ -1670,6 +3880,286 @@ class Snmp(object):
             return False
         return True
 
+class _PollerTimeout(Exception):
+    pass
+
+class SnmpPoller(object):
+    r"""Poll many hosts at the same time with a single asynchronous SNMP dispatcher
+
+    :class:`Snmp` is a blocking session on one host. The poller takes many jobs, each one being a host,
+    its credentials and the OIDs to get and/or to walk, and runs them all in the same pysnmp dispatcher :
+    requests to all hosts are in flight at the same time, one process can then poll a large
+    number of devices. Jobs with the same credentials share a pysnmp engine, SNMPv3 jobs with other
+    credentials get their own engine because users are registered by name in the engine. The number of requests in flight is limited per host and in total.
+    Each job result is a :class:`textops.DictExt` with the same values as :meth:`Snmp.mget` and
+    :meth:`Snmp.mwalk`.
+
+    Args:
+
+        timeout (int): The maximum time in seconds for :meth:`run` (Default : 60). Jobs that are
+            not finished get a :class:`TimeoutError`.
+        host_timeout (int): The maximum time in seconds for one host (Default : 30)
+        request_timeout (float): Time in seconds to wait a response before sending the request
+            again (Default : 3)
+        retries (int): Number of times a request is sent again without response (Default : 2)
+        max_host_requests (int): Maximum number of requests in flight for a same host (Default : 2)
+        max_requests (int): Maximum number of requests in flight in total (Default : 256)
+
+    Example::
+
+        poller = SnmpPoller(timeout=50)
+        for host in hosts:
+            poller.add_job(host, host, community='private',
+                           mget={'uptime':'1.3.6.1.2.1.1.3.0', 'name':'1.3.6.1.2.1.1.5.0'},
+                           mwalk={'ifdescr':'1.3.6.1.2.1.2.2.1.2'})
+        results = poller.run()
+        for host, error in poller.errors.items():
+            print host, 'failed :', error
+        print results[hosts[0]].uptime
+    """
+    def __init__(self, timeout=60, host_timeout=30, request_timeout=3, retries=2,
+                 max_host_requests=2, max_requests=256):
+        self.timeout = timeout
+        self.host_timeout = host_timeout
+        self.request_timeout = request_timeout
+        self.retries = retries
+        self.max_host_requests = max_host_requests
+        self.max_requests = max_requests
+        self.jobs = []
+        self.errors = {}
+
+    def add_job(self, key, host, mget=None, mwalk=None, community='public', version=None, port=161,
+                user=None, auth_passwd=None, auth_protocol='', priv_passwd=None, priv_protocol='',
+                bulk=None, max_repetitions=25):
+        """Add a host to poll
+
+        Args:
+
+            key (str): The job key in :meth:`run` results (usually the host name)
+            host (str): IP address or hostname to connect to
+            mget (dict): keyname/OID dictionary to get, like :meth:`Snmp.mget`
+            mwalk (dict): keyname/OID root path dictionary to walk, like :meth:`Snmp.mwalk`
+            community, version, port, user, auth_passwd, auth_protocol, priv_passwd, priv_protocol,
+                bulk, max_repetitions : Same as :class:`Snmp` parameters
+        """
+        from pysnmp.hlapi.asyncore import UdpTransportTarget
+        if not version:
+            version = user and 3 or 2
+        job = {'key':key,
+               'auth_data':_get_snmp_auth_data(version, community, user, auth_passwd, auth_protocol,
+                                               priv_passwd, priv_protocol),
+               'transport':UdpTransportTarget((host, port), timeout=self.request_timeout,
+                                              retries=self.retries),
+               'engine_key':_get_snmp_engine_key(version, user, auth_passwd, auth_protocol,
+                                                 priv_passwd, priv_protocol),
+               'engine':None,
+               'bulk':version != 1 if bulk is None else bulk,
+               'max_repetitions':max_repetitions,
+               'tasks':[],
+               'result':textops.DictExt(),
+               'in_flight':0,
+               'deadline':None,
+               'error':None}
+        if mget:
+            oids = []
+            oid_to_var = {}
+            for var,oid in mget.items():
+                for real_oid in (_get_snmp_oid_range(oid) if '-' in oid else [ oid ]):
+                    oids.append(real_oid)
+                    oid_to_var[real_oid] = var
+            job['tasks'].append(('get', oids, oid_to_var))
+        for var,oid in (mwalk or {}).items():
+            job['tasks'].append(('walk', var, oid))
+        self.jobs.append(job)
+
+    def _get_engine(self, job):
+        # every engine has its own transport domain in the shared dispatcher,
+        # so that responses are routed to the engine that sent the request
+        if job['engine'] is None:
+            engine_domain = self.engines.get(job['engine_key'])
+            if engine_domain is None:
+                from pysnmp.hlapi.asyncore import SnmpEngine
+                from pysnmp.carrier.asyncore.dgram import udp
+                engine = SnmpEngine()
+                domain = udp.domainName + (len(self.engines) + 1,)
+                engine.registerTransportDispatcher(self.dispatcher, domain)
+                engine_domain = self.engines[job['engine_key']] = (engine, domain)
+            job['engine'], job['transport'].transportDomain = engine_domain
+        return job['engine']
+
+    def _fail(self, job, error):
+        if job['error'] is None:
+            job['error'] = error
+            self.nb_in_flight -= job['in_flight']
+            job['in_flight'] = 0
+            job['tasks'] = []
+
+    def _task_done(self, job):
+        job['in_flight'] -= 1
+        self.nb_in_flight -= 1
+        if job['tasks'] and job['in_flight'] == self.max_host_requests - 1:
+            self.ready.append(job)
+        self._schedule()
+
+    def _get_error(self, errorIndication, errorStatus, errorIndex, varBinds):
+        if errorIndication:
+            return CollectError(errorIndication)
+        try:
+            err_at = errorIndex and varBinds[int(errorIndex)-1] or '?'
+        except:
+            err_at = '?'
+        return CollectError('%s at %s' % (errorStatus.prettyPrint(),err_at) )
+
+    def _start_get(self, job, oids, oid_to_var):
+        from pysnmp.hlapi.asyncore import getCmd, ContextData, ObjectType, ObjectIdentity
+        from pysnmp.proto.rfc1905 import NoSuchInstance, NoSuchObject
+        def cbFun(snmpEngine, sendRequestHandle, errorIndication, errorStatus, errorIndex, varBinds, cbCtx):
+            if job['error'] is not None:
+                return
+            if errorIndication or errorStatus:
+                self._fail(job, self._get_error(errorIndication, errorStatus, errorIndex, varBinds))
+                self._schedule()
+                return
+            if len(varBinds) != len(oids):
+                # values are matched to OIDs by position : a short response would lose some of them
+                self._fail(job, CollectError('%s values received for %s requested OIDs' % (len(varBinds), len(oids))))
+                self._schedule()
+                return
+            dct = job['result']
+            for (oid,val),req_oid in zip(varBinds,oids):
+                var = oid_to_var[req_oid]
+                val = NoAttr if isinstance(val,(NoSuchInstance,NoSuchObject)) else _snmp_to_native_type(val)
+                if var in dct:
+                    if isinstance(dct[var],list):
+                        dct[var].append(val)
+                    else:
+                        dct[var] = [dct[var],val]
+                else:
+                    dct[var] = val
+            self._task_done(job)
+        getCmd(self._get_engine(job), job['auth_data'], job['transport'], ContextData(),
+               *[ ObjectType(ObjectIdentity(oid)) for oid in oids ], cbFun=cbFun, lookupMib=False)
+
+    def _start_walk(self, job, var, oid):
+        from pysnmp.hlapi.asyncore import nextCmd, bulkCmd, ContextData
+        from pysnmp.hlapi.varbinds import CommandGeneratorVarBinds
+        from pysnmp.proto.rfc1902 import Null
+        from pysnmp.proto.rfc1905 import EndOfMibView
+        engine = self._get_engine(job)
+        oid = _normalize_snmp_oid(oid)
+        root = CommandGeneratorVarBinds().makeVarBinds(engine, [ (oid, Null('')) ])[0][0]
+        lst = textops.ListExt()
+        def cbFun(snmpEngine, sendRequestHandle, errorIndication, errorStatus, errorIndex, varBindTable, cbCtx):
+            if job['error'] is not None:
+                return False
+            if errorIndication or (errorStatus and errorStatus != 2):
+                self._fail(job, self._get_error(errorIndication, errorStatus, errorIndex,
+                                                varBindTable and varBindTable[-1]))
+                self._schedule()
+                return False
+            if not errorStatus:
+                varBinds = []
+                for varBindTableRow in varBindTable:
+                    for name, val in varBindTableRow:
+                        if isinstance(val, EndOfMibView) or not root.isPrefixOf(name):
+                            break
+                        varBinds.append((name, val))
+                    else:
+                        continue
+                    break
+                else:
+                    lst.extend(_snmp_varbinds_to_native(varBinds))
+                    return True
+                lst.extend(_snmp_varbinds_to_native(varBinds))
+            # end of the subtree (protocol 1 agents answer noSuchName at the end of the MIB)
+            job['result'][var] = lst
+            self._task_done(job)
+            return False
+        if job['bulk']:
+            bulkCmd(engine, job['auth_data'], job['transport'], ContextData(), 0, job['max_repetitions'],
+                    (root, Null('')), cbFun=cbFun, lookupMib=False)
+        else:
+            nextCmd(engine, job['auth_data'], job['transport'], ContextData(),
+                    (root, Null('')), cbFun=cbFun, lookupMib=False)
+
+    def _schedule(self):
+        while self.ready and self.nb_in_flight < self.max_requests:
+            job = self.ready.popleft()
+            if not job['tasks'] or job['error'] is not None:
+                continue
+            if job['deadline'] is None:
+                job['deadline'] = monotonic() + self.host_timeout
+                self.active.append(job)
+            task = job['tasks'].pop(0)
+            job['in_flight'] += 1
+            self.nb_in_flight += 1
+            try:
+                if task[0] == 'get':
+                    self._start_get(job, *task[1:])
+                else:
+                    self._start_walk(job, *task[1:])
+            except Exception,e:
+                self._fail(job, CollectError(e))
+                continue
+            if job['tasks'] and job['in_flight'] < self.max_host_requests:
+                self.ready.append(job)
+
+    def _check_deadlines(self, timeNow):
+        now = monotonic()
+        if now > self.deadline:
+            raise _PollerTimeout()
+        for job in self.active:
+            if job['error'] is None and (job['in_flight'] or job['tasks']) and now > job['deadline']:
+                self._fail(job, TimeoutError('Timeout (%ss) for host %s' % (self.host_timeout, job['key'])))
+        self.active = [ job for job in self.active if job['error'] is None and (job['in_flight'] or job['tasks']) ]
+        self._schedule()
+
+    def run(self):
+        """Poll all the hosts
+
+        The jobs added with :meth:`add_job` are removed once run.
+
+        Returns:
+
+            :class:`textops.DictExt`: job key / results dictionary. A job result is
+                a :class:`textops.DictExt` with the ``mget`` keys and the ``mwalk`` keys.
+                Jobs that failed are not in the returned dictionary : their exception
+                is in :attr:`errors` dictionary with the same key.
+        """
+        from pysnmp.carrier.asyncore.dispatch import AsyncoreDispatcher
+        import collections
+        self.dispatcher = AsyncoreDispatcher()
+        # responses are given to the engine owning the transport domain they are received on
+        self.dispatcher.registerRoutingCbFun(lambda domain, address, message: domain)
+        self.engines = {}
+        self.errors = {}
+        jobs, self.jobs = self.jobs, []
+        self.ready = collections.deque(jobs)
+        self.active = []
+        self.nb_in_flight = 0
+        timeout = limit_timeout(self.timeout)
+        self.deadline = monotonic() + timeout
+        naghelp.logger.debug('collect -> SnmpPoller.run() : %s jobs %s', len(jobs), naghelp.debug_caller())
+        self._schedule()
+        dispatcher = self.dispatcher
+        if self.engines:
+            dispatcher.registerTimerCbFun(self._check_deadlines)
+            try:
+                dispatcher.runDispatcher()
+            except _PollerTimeout:
+                for job in jobs:
+                    if job['in_flight'] or job['tasks']:
+                        self._fail(job, TimeoutError('Timeout (%ss) for SNMP poller' % timeout))
+            finally:
+                dispatcher.closeDispatcher()
+        dct = textops.DictExt()
+        for job in jobs:
+            if job['error'] is not None:
+                self.errors[job['key']] = job['error']
+            else:
+                dct[job['key']] = job['result']
+        return dct
+
 class Http(object):
     r"""Http class helper
 
@@ -19,7 +19,7 @@ from .response import PluginResponse, OK, WARNING, CRITICAL, UNKNOWN
 import tempfile
 from addicted import NoAttr, NoAttrDict
 import textops
-from collect import search_invalid_port
+from collect import search_invalid_ports
 import datetime
 import naghelp
 import socket
@@ -912,12 +912,18 @@ class ActivePlugin(Plugin):
         """Checks port
 
         This method is called when an error occurs while collecting data from host : It will check
-        whether the tcp ports are reachable or not. If not, the plugin exits with a fast response.
+        whether the tcp ports are reachable or not. If not, the plugin exits with a fast response
+        listing all the unreachable ports. Ports are probed at the same time (see
+        :func:`naghelp.probe_ports`).
         """
-        invalid_port = search_invalid_port(self.host.ip,self.get_tcp_ports())
-        if invalid_port:
+        invalid_ports = search_invalid_ports(self.host.ip,self.get_tcp_ports())
+        if invalid_ports:
+            if len(invalid_ports) == 1:
+                synopsis = 'Port %s is unreachable' % invalid_ports[0]
+            else:
+                synopsis = 'Ports %s are unreachable' % ','.join([ str(p) for p in invalid_ports ])
             self.fast_response(CRITICAL,
-                               'Port %s is unreachable' % invalid_port,
+                               synopsis,
                                'This plugin uses ports tcp = %s, udp = %s\nplease check your firewall\n\n' % (self.get_tcp_ports() or 'none',self.get_udp_ports() or 'none'),
                                2)
 
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""This module provides a local broker that keeps SSH connections opened between plugin executions
+
+Opening an SSH connection (TCP handshake, key exchange and authentication) may take more time
+than the command itself, especially on slow BMCs. The broker is a background process that keeps
+authenticated connections per (host, port, user) and executes commands on them on behalf of
+plugins : it listens on a unix socket, each request opens a new channel on a warm connection.
+Connections that are not used for ``idle_timeout`` seconds are closed, the broker exits itself
+when it has nothing to do anymore.
+
+The :class:`naghelp.collect.Ssh` collector uses the broker only when ``use_broker=True`` and falls
+back to a direct connection while the broker is not available. The broker is started by the collector
+only with ``start_broker=True``, otherwise it must be started manually::
+
+    python -m naghelp.sshbroker --idle-timeout 300
+
+Warning:
+
+    Plugins send the SSH passwords to the broker in clear text over its unix socket. The socket is
+    created in a directory private to the user (mode 0700) and is only accessible to that user (mode 0600).
+    Plugins check that the socket and its directory belong to them before sending anything, otherwise
+    they use a direct connection. Still, the broker is a long-lived process holding the passwords
+    and the opened connections : use it only on hosts where this is acceptable.
+"""
+
+import os
+import sys
+import stat
+import socket
+import json
+import errno
+import hashlib
+import threading
+import subprocess
+import naghelp
+from .tools import Lockfile, TimeoutError, monotonic
+
+__all__ = ['SshBroker', 'BrokerUnavailable', 'broker_exec', 'start_broker', 'SSH_BROKER_SOCKET']
+
+SSH_BROKER_SOCKET = '/tmp/naghelp-%s/ssh_broker.sock' % os.getuid()
+"""The default unix socket path the SSH broker is listening on, in a directory private to the user"""
+
+# paramiko connect() parameters that can be sent to the broker
+BROKER_CONNECT_KWARGS = ('port', 'key_filename', 'allow_agent', 'look_for_keys', 'compress',
+                         'gss_auth', 'gss_kex', 'gss_deleg_creds', 'gss_host', 'banner_timeout')
+
+class BrokerUnavailable(Exception):
+    """Exception raised when the SSH broker cannot be reached"""
+    pass
+
+def _encode(data):
+    # command outputs may not be utf-8 : latin-1 maps every byte to a char and back
+    return data.decode('latin-1')
+
+def _decode(data):
+    return data.encode('latin-1')
+
+def _check_socket(socket_path):
+    # the password is sent to the broker : the socket must belong to the current user,
+    # in a directory where other users cannot create or replace it
+    uid = os.getuid()
+    try:
+        dir_stat = os.stat(os.path.dirname(os.path.abspath(socket_path)))
+        sock_stat = os.lstat(socket_path)
+    except OSError,e:
+        raise BrokerUnavailable('Cannot connect to SSH broker %s : %s' % (socket_path,e))
+    if dir_stat.st_uid != uid or dir_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise BrokerUnavailable('SSH broker %s is in a directory that is not private to the user' % socket_path)
+    if sock_stat.st_uid != uid or not stat.S_ISSOCK(sock_stat.st_mode):
+        raise BrokerUnavailable('SSH broker %s is not a socket owned by the user' % socket_path)
+
+def broker_exec(request, socket_path=SSH_BROKER_SOCKET):
+    """Send a request to the SSH broker and wait for its response
+
+    Args:
+
+        request (dict): The request with keys ``host``, ``user``, ``password``, ``cmd``,
+            ``timeout``, ``get_pty``, ``auto_accept_new_host`` and ``connect_kwargs``
+        socket_path (str): The broker unix socket path
+
+    Returns:
+
+        dict: The response with keys ``out`` and ``err`` or ``error`` and ``message``
+
+    Raises:
+
+        BrokerUnavailable: When the broker is not running or did not answer, or when the socket
+            or its directory do not belong to the current user
+    """
+    _check_socket(socket_path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # leave time to the broker to connect to the host and to run the command
+        sock.settimeout(request.get('timeout',30) * 2 + 1)
+        try:
+            sock.connect(socket_path)
+        except socket.error,e:
+            raise BrokerUnavailable('Cannot connect to SSH broker %s : %s' % (socket_path,e))
+        try:
+            sock.sendall(json.dumps(request) + '\n')
+            line = sock.makefile('rb').readline()
+        except socket.error,e:
+            raise BrokerUnavailable('SSH broker %s did not answer : %s' % (socket_path,e))
+        if not line:
+            raise BrokerUnavailable('SSH broker %s closed the connection' % socket_path)
+        response = json.loads(line)
+        for k in ('out','err'):
+            if k in response:
+                response[k] = _decode(response[k])
+        return response
+    finally:
+        sock.close()
+
+def start_broker(socket_path=SSH_BROKER_SOCKET, idle_timeout=300):
+    """Start the SSH broker in background
+
+    It returns immediately. If a broker is already listening on ``socket_path``, the new process
+    will exit by itself.
+
+    Args:
+
+        socket_path (str): The broker unix socket path
+        idle_timeout (int): Time in seconds after which an unused connection is closed
+    """
+    naghelp.logger.debug('SSH broker : starting on %s', socket_path)
+    with open(os.devnull, 'r+') as devnull:
+        subprocess.Popen([sys.executable, '-m', 'naghelp.sshbroker', '--socket', socket_path,
+                          '--idle-timeout', str(idle_timeout)],
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=os.setsid)
+
+class SshBroker(object):
+    """Local SSH broker
+
+    Keeps authenticated SSH connections and executes commands on them for the plugins
+    connecting to its unix socket. One request per socket connection : a json line with the
+    connection parameters and the command, the response is a json line too.
+
+    Args:
+
+        socket_path (str): The unix socket path to listen on (Default : :data:`SSH_BROKER_SOCKET`)
+        idle_timeout (int): Time in seconds after which an unused connection is closed. The broker
+            exits when it has no connection and no request during that time. (Default : 300s)
+    """
+    client_timeout = 30
+    """Time in seconds to wait for a client request line or for sending the response to the client"""
+
+    def __init__(self, socket_path=SSH_BROKER_SOCKET, idle_timeout=300):
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.last_request = monotonic()
+        self.running = False
+
+    def _get_key(self, request):
+        password = request.get('password') or ''
+        return json.dumps([request['host'], request['user'], hashlib.sha1(password.encode('utf-8')).hexdigest(),
+                           request.get('connect_kwargs',{})], sort_keys=True)
+
+    def _connect(self, request):
+        import paramiko
+        client = paramiko.SSHClient()
+        if request.get('auto_accept_new_host',True):
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.load_system_host_keys()
+        client.connect(request['host'], username=request['user'], password=request.get('password'),
+                       timeout=request.get('timeout',30), **request.get('connect_kwargs',{}))
+        naghelp.logger.debug('SSH broker : connected to %s@%s', request['user'], request['host'])
+        return client
+
+    def _get_entry(self, key):
+        with self.lock:
+            entry = self.clients.get(key)
+            if entry is None:
+                entry = self.clients[key] = {'client':None, 'lock':threading.Lock(), 'last_used':monotonic()}
+            return entry
+
+    def _get_client(self, request, key):
+        entry = self._get_entry(key)
+        with entry['lock']:
+            client = entry['client']
+            transport = client and client.get_transport()
+            if transport is None or not transport.is_active():
+                if client:
+                    client.close()
+                entry['client'] = None
+                client = entry['client'] = self._connect(request)
+            entry['last_used'] = monotonic()
+            return client
+
+    def _drop_client(self, key):
+        with self.lock:
+            entry = self.clients.pop(key, None)
+        if entry and entry['client']:
+            entry['client'].close()
+
+    def _exec(self, client, request):
+        stdin, stdout, stderr = client.exec_command(request['cmd'], timeout=request.get('timeout',30),
+                                                    get_pty=request.get('get_pty',False))
+        return {'out':_encode(stdout.read()), 'err':_encode(stderr.read())}
+
+    def handle_request(self, request):
+        """Execute a request and returns the response dict"""
+        import paramiko
+        key = self._get_key(request)
+        try:
+            client = self._get_client(request, key)
+        except Exception,e:
+            self._drop_client(key)
+            return {'error':'connection', 'message':str(e)}
+        try:
+            return self._exec(client, request)
+        except socket.timeout:
+            return {'error':'timeout', 'message':'Timeout for command : %s' % request['cmd']}
+        except (paramiko.SSHException, socket.error, EOFError):
+            # the connection may have been closed by the host : retry once with a new one
+            self._drop_client(key)
+        try:
+            return self._exec(self._get_client(request, key), request)
+        except socket.timeout:
+            return {'error':'timeout', 'message':'Timeout for command : %s' % request['cmd']}
+        except Exception,e:
+            self._drop_client(key)
+            return {'error':'connection', 'message':str(e)}
+
+    def _handle_connection(self, conn):
+        try:
+            line = conn.makefile('rb').readline()
+            if line:
+                response = self.handle_request(json.loads(line))
+                conn.sendall(json.dumps(response) + '\n')
+        except Exception,e:
+            naghelp.logger.debug('SSH broker : error while handling a request : %s', e)
+        finally:
+            conn.close()
+            self.last_request = monotonic()
+
+    def evict_idle(self):
+        """Close the connections that have not been used for ``idle_timeout`` seconds"""
+        now = monotonic()
+        with self.lock:
+            idle_keys = [ k for k,entry in self.clients.items()
+                          if now - entry['last_used'] > self.idle_timeout and not entry['lock'].locked() ]
+            idle_entries = [ self.clients.pop(k) for k in idle_keys ]
+        for entry in idle_entries:
+            if entry['client']:
+                entry['client'].close()
+        if idle_entries:
+            naghelp.logger.debug('SSH broker : %s idle connection(s) closed', len(idle_entries))
+
+    def serve_forever(self):
+        """Listen on the unix socket and serve requests
+
+        It returns when the broker has been idle for ``idle_timeout`` seconds or after
+        :meth:`shutdown`. It returns immediately if another broker is already running on the
+        same socket.
+        """
+        socket_dir = os.path.dirname(os.path.abspath(self.socket_path))
+        if not os.path.isdir(socket_dir):
+            # plugins only talk to a broker whose socket directory is private
+            os.makedirs(socket_dir, 0700)
+        try:
+            lock = Lockfile(self.socket_path, timeout=0)
+            lock.acquire()
+        except TimeoutError:
+            naghelp.logger.debug('SSH broker : already running on %s', self.socket_path)
+            return
+        try:
+            try:
+                os.unlink(self.socket_path)
+            except OSError,e:
+                if e.errno != errno.ENOENT:
+                    raise
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            old_umask = os.umask(0177)
+            try:
+                sock.bind(self.socket_path)
+            finally:
+                os.umask(old_umask)
+            sock.listen(64)
+            sock.settimeout(min(self.idle_timeout / 2.0, 5))
+            self.running = True
+            naghelp.logger.debug('SSH broker : listening on %s', self.socket_path)
+            while self.running:
+                try:
+                    conn, addr = sock.accept()
+                except socket.timeout:
+                    self.evict_idle()
+                    if not self.clients and monotonic() - self.last_request > self.idle_timeout:
+                        break
+                    continue
+                # a stuck client must not hold a handler thread forever
+                conn.settimeout(self.client_timeout)
+                self.last_request = monotonic()
+                t = threading.Thread(target=self._handle_connection, args=(conn,))
+                t.daemon = True
+                t.start()
+            sock.close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+            for key in self.clients.keys():
+                self._drop_client(key)
+        finally:
+            self.running = False
+            lock.release()
+
+    def shutdown(self):
+        """Stop :meth:`serve_forever` loop"""
+        self.running = False
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='naghelp SSH broker')
+    parser.add_argument('--socket', default=SSH_BROKER_SOCKET, help='unix socket path to listen on')
+    parser.add_argument('--idle-timeout', type=int, default=300,
+                        help='seconds after which an unused connection is closed')
+    args = parser.parse_args()
+    SshBroker(args.socket, args.idle_timeout).serve_forever()
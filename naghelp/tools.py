@@ -9,11 +9,16 @@
 import signal
 import naghelp
 import time
+import threading
 import fcntl
 import errno
 import os
+import json
+import hashlib
+import Queue
+import atexit
 
-__all__ = ['Timeout', 'TimeoutError', 'Lockfile']
+__all__ = ['Timeout', 'TimeoutError', 'Lockfile', 'ResultCache', 'CollectFuture', 'CollectorPool', 'COLLECTOR_POOL', 'gather_results', 'time_left', 'limit_timeout', 'limit_timeout_error', 'monotonic']
 
 class TimeoutError(Exception):
     """Exception raised when a connection or a collect it too long to process
@@ -23,15 +28,165 @@ class TimeoutError(Exception):
     """
     pass
 
+def _get_monotonic():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        import ctypes, ctypes.util
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'))
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1
+        def monotonic():
+            t = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)):
+                return time.time()
+            return t.tv_sec + t.tv_nsec * 1e-9
+        monotonic()
+        return monotonic
+    except Exception:
+        return time.time
+
+monotonic = _get_monotonic()
+"""Returns a clock value in seconds (float) that cannot go backwards
+
+Use it to measure durations : system clock adjustments do not affect it.
+"""
+
+_deadlines = threading.local()
+
+def _get_deadlines():
+    stack = getattr(_deadlines, 'stack', None)
+    if stack is None:
+        stack = _deadlines.stack = []
+    return stack
+
+def _in_main_thread():
+    return isinstance(threading.current_thread(), threading._MainThread)
+
+def _check_deadlines(stack):
+    now = monotonic()
+    for t in stack:
+        if t.deadline is not None and t.deadline <= now:
+            raise TimeoutError(t.error_message)
+
+def _arm_alarm(stack):
+    deadlines = [ t.deadline for t in stack if t.deadline is not None ]
+    if deadlines:
+        signal.setitimer(signal.ITIMER_REAL, max(min(deadlines) - monotonic(), 0.001))
+    else:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+def _handle_alarm(signum, frame):
+    stack = _get_deadlines()
+    _check_deadlines(stack)
+    # the alarm rang a little too early : wait again for the nearest deadline
+    _arm_alarm(stack)
+
+def time_left():
+    """Returns the time left before the nearest :class:`Timeout` deadline
+
+    Returns:
+
+        float: The time left in seconds (may be negative if the deadline is over)
+            or None if the current code is not running within a :class:`Timeout` block.
+
+    Examples:
+
+        >>> print time_left()
+        None
+        >>> with Timeout(seconds=10):
+        ...     with Timeout(seconds=60):
+        ...         print '%.0f' % time_left()
+        10
+    """
+    deadlines = [ t.deadline for t in _get_deadlines() if t.deadline is not None ]
+    if deadlines:
+        return min(deadlines) - monotonic()
+    return None
+
+def limit_timeout(timeout):
+    """Limit a timeout to the time left before the nearest :class:`Timeout` deadline
+
+    Collectors use this to give their socket/process timeouts the remaining time budget.
+
+    Args:
+
+        timeout (int or float): the wanted timeout in seconds (None or 0 : no timeout)
+
+    Returns:
+
+        float: The effective timeout in seconds, never below 1 millisecond, or ``timeout`` unchanged
+            when not in a :class:`Timeout` block.
+
+    Examples:
+
+        >>> limit_timeout(30)
+        30
+        >>> with Timeout(seconds=5):
+        ...     print '%.0f' % limit_timeout(30)
+        5
+    """
+    left = time_left()
+    if left is None:
+        return timeout
+    left = max(left, 0.001)
+    if not timeout:
+        return left
+    return min(timeout, left)
+
+def limit_timeout_error(timeout, error_message):
+    """Limit a timeout like :func:`limit_timeout` and give the error message of the deadline that fires
+
+    When an enclosing :class:`Timeout` deadline comes before ``timeout``, this is the deadline that will
+    stop the collect : its error message must be reported instead of ``error_message``.
+
+    Args:
+
+        timeout (int or float): the wanted timeout in seconds (None or 0 : no timeout)
+        error_message (str): the error message for ``timeout``
+
+    Returns:
+
+        tuple: The effective timeout (see :func:`limit_timeout`) and the error message to use
+
+    Examples:
+
+        >>> limit_timeout_error(30, 'Timeout (30s) for command')
+        (30, 'Timeout (30s) for command')
+        >>> with Timeout(seconds=0.5, error_message='Timeout (0.5s) for the check'):
+        ...     print limit_timeout_error(30, 'Timeout (30s) for command')[1]
+        Timeout (0.5s) for the check
+    """
+    blocks = [ t for t in _get_deadlines() if t.deadline is not None ]
+    if not blocks:
+        return timeout, error_message
+    nearest = min(blocks, key=lambda t:t.deadline)
+    left = max(nearest.deadline - monotonic(), 0.001)
+    if not timeout or left < timeout:
+        return left, nearest.error_message
+    return timeout, error_message
+
 class Timeout:
     """Set an execution timeout for a block of code
 
-    It uses process signals, it should not work on windows platforms.
+    Timeouts have a sub-second precision and can be nested : an inner block never extends the
+    outer block deadline, and when the outer deadline is reached inside an inner block, the outer
+    TimeoutError is raised. Use :func:`time_left` or :func:`limit_timeout` to know the time
+    left to the nearest deadline.
+
+    In the main thread, it uses process signals (SIGALRM) to interrupt the block : it should not
+    work on windows platforms. In other threads, the block is not interrupted but the deadline is
+    still available for :func:`time_left` and :func:`limit_timeout` : this is how collectors
+    get their timeout budget.
 
     Args:
 
-        seconds (int): The time in seconds after which a TimeoutError will be raise if the block
-            has not finished its execution.
+        seconds (int or float): The time in seconds after which a TimeoutError will be raise if the block
+            has not finished its execution. None or 0 means no timeout for this block
+            (outer blocks deadlines still apply).
         error_message(str): The string to pass to the TimeoutError exception.
 
     Raises:
@@ -40,20 +195,55 @@ class Timeout:
 
     Examples:
 
-        >>> with timeout(seconds=3):
-        >>>     time.sleep(4)
+        >>> import time
+        >>> with Timeout(seconds=0.5):
+        ...     time.sleep(4)
+        Traceback (most recent call last):
+        ...
+        TimeoutError: Timeout
+
+        >>> with Timeout(seconds=1, error_message='outer timeout'):
+        ...     with Timeout(seconds=30, error_message='inner timeout'):
+        ...         time.sleep(4)
+        Traceback (most recent call last):
+        ...
+        TimeoutError: outer timeout
 
     """
     def __init__(self, seconds=1, error_message='Timeout'):
         self.seconds = seconds
         self.error_message = error_message
-    def handle_timeout(self, signum, frame):
-        raise TimeoutError(self.error_message)
+        self.deadline = None
+        self._prev_handler = None
+
+    def remaining(self):
+        """Returns the time left in seconds for this block (None if no deadline)"""
+        if self.deadline is None:
+            return None
+        return self.deadline - monotonic()
+
     def __enter__(self):
-        signal.signal(signal.SIGALRM, self.handle_timeout)
-        signal.alarm(self.seconds)
+        stack = _get_deadlines()
+        # an outer deadline may have been reached while its TimeoutError has been caught
+        _check_deadlines(stack)
+        self.deadline = monotonic() + self.seconds if self.seconds else None
+        if _in_main_thread():
+            if not stack:
+                self._prev_handler = signal.signal(signal.SIGALRM, _handle_alarm)
+            stack.append(self)
+            _arm_alarm(stack)
+        else:
+            stack.append(self)
+        return self
+
     def __exit__(self, type, value, traceback):
-        signal.alarm(0)
+        stack = _get_deadlines()
+        if self in stack:
+            stack.remove(self)
+        if _in_main_thread():
+            _arm_alarm(stack)
+            if not stack:
+                signal.signal(signal.SIGALRM, self._prev_handler or signal.SIG_DFL)
 
 class Lockfile:
     """Acquire a lock on a file, release it at the end
@@ -121,3 +311,374 @@ class Lockfile:
 
     def __del__(self):
         self.release()
+
+def _json_to_str(data):
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    if isinstance(data, list):
+        return [ _json_to_str(v) for v in data ]
+    if isinstance(data, dict):
+        return dict([ (_json_to_str(k),_json_to_str(v)) for k,v in data.items() ])
+    return data
+
+class ResultCache(object):
+    """On-disk cache for collected results
+
+    Several plugins may run the same commands on the same host within a few seconds. This cache
+    stores the results in files with a time to live, so that they can be shared between plugin
+    processes. A lock is taken while collecting : if many processes need the same missing result,
+    only one of them will collect it, the others will wait and read the cached result.
+    Expired entries are removed each time a result is stored, then the entries expiring first
+    are removed until the cache directory fits in ``max_size``.
+
+    Results must be json serializable (strings, numbers, lists or dicts).
+
+    Args:
+
+        cache_dir (str): The directory where to store cache files (Default : /tmp/naghelp/cache)
+        max_size (int): The maximum cache directory size in bytes (Default : 10MB)
+        lock_timeout (int): The maximum time to wait for another process to collect the same
+            result (Default : 60s)
+
+    Examples:
+
+        >>> cache = ResultCache('/tmp/naghelp/doctest_cache')
+        >>> cache.get_or_collect(('local','myhost','uname -a'), 60, lambda: 'Linux myhost 3.13.0')
+        'Linux myhost 3.13.0'
+        >>> cache.get(('local','myhost','uname -a'))
+        'Linux myhost 3.13.0'
+        >>> cache.get_or_collect(('local','myhost','uname -a'), 60, lambda: 'not called')
+        'Linux myhost 3.13.0'
+    """
+    def __init__(self, cache_dir='/tmp/naghelp/cache', max_size=10*1024*1024, lock_timeout=60):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock_timeout = lock_timeout
+
+    def _get_key_str(self, key):
+        return json.dumps(key, sort_keys=True, default=repr)
+
+    def _get_filename(self, key_str):
+        return os.path.join(self.cache_dir, hashlib.sha1(key_str).hexdigest() + '.json')
+
+    def _read(self, filename, key_str):
+        try:
+            with open(filename) as fh:
+                entry = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return False, None
+        if entry.get('key') != key_str or entry.get('expires',0) < time.time():
+            return False, None
+        return True, _json_to_str(entry.get('value'))
+
+    def _write(self, filename, key_str, value, ttl):
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            tmp_filename = '%s.%s' % (filename, os.getpid())
+            now = time.time()
+            with open(tmp_filename,'w') as fh:
+                json.dump({'key':key_str, 'expires':now + ttl, 'value':value}, fh)
+            # the file modification time is the expiration time : evict() does not read the files
+            os.utime(tmp_filename, (now, now + ttl))
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError, TypeError, ValueError),e:
+            naghelp.logger.debug('CACHE : cannot write %s : %s', filename, e)
+
+    def evict(self):
+        """Remove expired entries, then the ones expiring first until the cache fits in ``max_size``"""
+        entries = []
+        total_size = 0
+        now = time.time()
+        try:
+            filenames = os.listdir(self.cache_dir)
+        except OSError:
+            return
+        for name in filenames:
+            if not name.endswith('.json'):
+                continue
+            filename = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+            total_size += st.st_size
+        nb_evicted = 0
+        for expires, size, filename in sorted(entries):
+            if expires >= now and total_size <= self.max_size:
+                break
+            try:
+                os.unlink(filename)
+                total_size -= size
+                nb_evicted += 1
+            except OSError:
+                pass
+        if nb_evicted:
+            naghelp.logger.debug('CACHE : %s entries evicted, size is now %s bytes', nb_evicted, total_size)
+
+    def get(self, key, default=None):
+        """Get a result from the cache
+
+        Args:
+
+            key (tuple): The result key, usually (transport, host, command, context...)
+            default: The value to return if the key is not in the cache or has expired
+
+        Returns:
+
+            The cached result or ``default``
+        """
+        key_str = self._get_key_str(key)
+        found, value = self._read(self._get_filename(key_str), key_str)
+        return value if found else default
+
+    def set(self, key, value, ttl):
+        """Store a result into the cache
+
+        Args:
+
+            key (tuple): The result key, usually (transport, host, command, context...)
+            value: The result to store (json serializable)
+            ttl (int): The result time to live in seconds
+        """
+        key_str = self._get_key_str(key)
+        self._write(self._get_filename(key_str), key_str, value, ttl)
+        self.evict()
+
+    def get_or_collect(self, key, ttl, collect):
+        """Get a result from the cache or collect it
+
+        If the result is not in the cache, a lock is taken, ``collect()`` is called and its result
+        is stored. Other processes asking for the same key at the same time will wait for
+        the lock and then get the stored result. Exceptions raised by ``collect()`` are not
+        cached.
+
+        Args:
+
+            key (tuple): The result key, usually (transport, host, command, context...)
+            ttl (int): The result time to live in seconds
+            collect (callable): the function without arguments that returns the result.
+
+        Returns:
+
+            The cached or collected result
+        """
+        key_str = self._get_key_str(key)
+        filename = self._get_filename(key_str)
+        found, value = self._read(filename, key_str)
+        if found:
+            naghelp.logger.debug('CACHE : hit for %s', key_str)
+            return value
+        with Lockfile(filename[:-5], timeout=self.lock_timeout):
+            # another process may have collected the result while we were waiting for the lock
+            found, value = self._read(filename, key_str)
+            if found:
+                naghelp.logger.debug('CACHE : hit for %s', key_str)
+                return value
+            naghelp.logger.debug('CACHE : miss for %s', key_str)
+            value = collect()
+            self._write(filename, key_str, value, ttl)
+        self.evict()
+        return value
+
+class CollectFuture(object):
+    """The result of a collect that is running in background
+
+    This is a minimal equivalent of python 3 ``concurrent.futures.Future`` returned by
+    :meth:`CollectorPool.submit` and by asynchronous collectors (:class:`naghelp.AsyncSsh`...).
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        """Returns True if the collect is finished"""
+        return self._event.is_set()
+
+    def _finish(self, result, exception):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        self._finish(None, exception)
+
+    def add_done_callback(self, callback):
+        """Call ``callback(future)`` when the collect is finished (immediately if already finished)"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def exception(self, timeout=None):
+        """Wait the collect and returns the raised exception or None
+
+        Args:
+
+            timeout (float): The maximum time to wait in seconds (Default : no limit)
+
+        Raises:
+
+            TimeoutError: if the collect is not finished within ``timeout`` seconds
+        """
+        if not self._event.wait(timeout):
+            raise TimeoutError('Timeout (%ss) while waiting a collect result' % timeout)
+        return self._exception
+
+    def result(self, timeout=None):
+        """Wait the collect and returns its result
+
+        The exception raised by the collect, if any, is raised again here.
+
+        Args:
+
+            timeout (float): The maximum time to wait in seconds (Default : no limit)
+
+        Raises:
+
+            TimeoutError: if the collect is not finished within ``timeout`` seconds
+        """
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+class CollectorPool(object):
+    """A pool of threads shared by all asynchronous collects of a process
+
+    Collectors are blocking on I/O, a process driving many devices at once runs them in this pool.
+    Threads are started on demand up to ``max_workers`` and stop by themselves after
+    ``idle_timeout`` seconds without work. The default pool is :data:`COLLECTOR_POOL`.
+    Idle threads are stopped by :meth:`shutdown`, which is automatically called at interpreter exit.
+
+    Args:
+
+        max_workers (int): The maximum number of threads (Default : 64)
+        idle_timeout (float): Time in seconds after which an idle thread stops (Default : 5)
+
+    Examples:
+
+        >>> pool = CollectorPool(max_workers=4)
+        >>> futures = [ pool.submit(lambda x: x*2, i) for i in range(5) ]
+        >>> gather_results(futures, timeout=10)
+        [0, 2, 4, 6, 8]
+        >>> pool.shutdown()
+        >>> pool.submit(lambda x: x*2, 1)
+        Traceback (most recent call last):
+        ...
+        RuntimeError: cannot submit a collect to a pool that has been shut down
+    """
+    def __init__(self, max_workers=64, idle_timeout=5):
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._nb_threads = 0
+        self._nb_idle = 0
+        self._is_shutdown = False
+        atexit.register(self.shutdown)
+
+    def _worker(self, Empty=Queue.Empty):
+        # Queue.Empty is bound at definition : module globals may already be None
+        # when a daemon thread wakes up during interpreter shutdown
+        while True:
+            with self._lock:
+                self._nb_idle += 1
+            try:
+                task = self._queue.get(True, self.idle_timeout)
+            except Empty:
+                with self._lock:
+                    self._nb_idle -= 1
+                    # do not leave a task without thread if one has been queued meanwhile
+                    if self._queue.empty():
+                        self._nb_threads -= 1
+                        return
+                continue
+            with self._lock:
+                self._nb_idle -= 1
+                if task is None:
+                    # sentinel sent by shutdown()
+                    self._nb_threads -= 1
+                    return
+            future, func, args, kwargs = task
+            try:
+                result = func(*args, **kwargs)
+            except Exception,e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def submit(self, func, *args, **kwargs):
+        """Run ``func(*args, **kwargs)`` in the pool
+
+        Returns:
+
+            :class:`CollectFuture`: The future result
+        """
+        future = CollectFuture()
+        with self._lock:
+            if self._is_shutdown:
+                raise RuntimeError('cannot submit a collect to a pool that has been shut down')
+            self._queue.put((future, func, args, kwargs))
+            if self._nb_idle < self._queue.qsize() and self._nb_threads < self.max_workers:
+                self._nb_threads += 1
+                t = threading.Thread(target=self._worker)
+                t.daemon = True
+                t.start()
+        return future
+
+    def shutdown(self):
+        """Stop the pool threads
+
+        One sentinel per thread is queued after the pending tasks : these are still run,
+        then threads exit. No more task can be submitted afterwards.
+        """
+        with self._lock:
+            if self._is_shutdown:
+                return
+            self._is_shutdown = True
+            for i in xrange(self._nb_threads):
+                self._queue.put(None)
+
+COLLECTOR_POOL = CollectorPool()
+"""The default :class:`CollectorPool` used by asynchronous collectors"""
+
+def gather_results(futures, timeout=None, return_exceptions=False):
+    """Wait for many futures and returns their results
+
+    Args:
+
+        futures (list): A list of :class:`CollectFuture`
+        timeout (float): The maximum time to wait for all results in seconds (Default : no limit)
+        return_exceptions (bool): If True, exceptions are returned in the list instead
+            of being raised
+
+    Returns:
+
+        list: The results in the same order as ``futures``
+
+    Raises:
+
+        TimeoutError: if the results are not all available within ``timeout`` seconds
+    """
+    deadline = None if timeout is None else monotonic() + timeout
+    results = []
+    for future in futures:
+        remaining = None if deadline is None else max(deadline - monotonic(), 0)
+        exception = future.exception(remaining)
+        if exception is not None and not return_exceptions:
+            raise exception
+        results.append(exception if exception is not None else future.result(0))
+    return results
@@ -8,8 +8,12 @@ modules = [ 'naghelp.host',
             'naghelp.response',
             'naghelp.launcher',
             'naghelp.mixins',
+            'naghelp.tools',
+            'naghelp.collect',
             ]
-files = [ 'docs/intro.rst' ]
+files = [ 'docs/intro.rst',
+          'tests/collect.rst',
+          ]
 
 failed = 0
 tested = 0